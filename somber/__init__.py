@@ -3,10 +3,12 @@ from .som import Som
 from .plsom import PLSom
 from .ng import Ng
 from .sequential import RecursiveSom, RecursiveNg
+from .sweep import sweep
 
 __all__ = ['Som',
            'Ng',
            'RecursiveSom',
            'RecursiveNg',
            'PLSom',
+           'sweep',
            'MiikkulainenSom']
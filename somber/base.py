@@ -3,13 +3,22 @@ import numpy as np
 import logging
 import time
 import types
-import json
 
 from tqdm import tqdm
-from .components.utilities import shuffle, Scaler
+from concurrent.futures import ThreadPoolExecutor
+from .components.utilities import (scatter_add,
+                                   top_k,
+                                   ordered_map,
+                                   Scaler,
+                                   Batches,
+                                   ChunkReader)
 from .components.initializers import range_initialization
-from .distance import euclidean
-from collections import Counter, defaultdict
+from .components.grid import SparseInfluence
+from .components.serialization import load_model, save_model
+from .components.index import InvertedIndex
+from .components.receptive import ReceptiveField
+from .components.inference import InferenceForm
+from .distance import euclidean_distance
 
 
 logger = logging.getLogger(__name__)
@@ -44,6 +53,10 @@ class Base(object):
         An initialized instance of Scaler() which is used to scale the data
         to have mean 0 and stdev 1. If this is set to None, the SOM will
         create a scaler.
+    dtype : numpy dtype, optional, default np.float64
+        The floating point type of the weights, and of all computations
+        during training and transformation. np.float32 halves the memory
+        use, and is faster.
 
     Attributes
     ----------
@@ -53,16 +66,26 @@ class Base(object):
         The weight matrix.
     param_names : set
         The parameter names. Used in saving.
+    algorithms : tuple of str
+        The training algorithms the learner supports, see fit.
 
     """
 
+    # The training algorithms which can be passed to fit.
+    algorithms = ("online",)
+
     # Static property names
     param_names = {'num_neurons',
                    'weights',
                    'data_dimensionality',
                    'params',
                    'valfunc',
-                   'argfunc'}
+                   'argfunc',
+                   'dtype'}
+
+    # The thread pool used during training, see fit.
+    _pool = None
+    _n_jobs = 1
 
     def __init__(self,
                  num_neurons,
@@ -71,17 +94,22 @@ class Base(object):
                  argfunc="argmin",
                  valfunc="min",
                  initializer=range_initialization,
-                 scaler=None):
+                 scaler=None,
+                 dtype=np.float64):
         """Organize nothing."""
         self.num_neurons = np.int(num_neurons)
         self.data_dimensionality = data_dimensionality
+        self.dtype = np.dtype(dtype)
         if self.data_dimensionality:
-            self.weights = np.zeros((num_neurons, data_dimensionality))
+            self.weights = np.zeros((num_neurons, data_dimensionality),
+                                    dtype=self.dtype)
         else:
             self.weights = None
         self.argfunc = argfunc
         self.valfunc = valfunc
         self.trained = False
+        self.index = None
+        self.inference = None
         if scaler is None:
             self.scaler = Scaler()
         self.initializer = initializer
@@ -96,14 +124,21 @@ class Base(object):
             batch_size=1,
             show_progressbar=False,
             show_epoch=False,
-            refit=True):
+            refit=True,
+            algorithm="online",
+            n_jobs=1,
+            chunk_size=100000):
         """
         Fit the learner to some data.
 
         Parameters
         ----------
-        X : numpy array.
-            The input data.
+        X : numpy array, memory-mapped array or iterable of arrays.
+            The input data. If the data is a memory-mapped array or an
+            iterable of arrays (e.g. a list of memory-mapped arrays), it is
+            streamed: the data is read in chunks, and never loaded into
+            memory as a whole. An iterable is read once per epoch, and can
+            therefore not be a generator.
         num_epochs : int, optional, default 10
             The number of epochs to train for.
         updates_epoch : int, optional, default 10
@@ -120,52 +155,156 @@ class Base(object):
             Whether to show a progressbar during training.
         show_epoch : bool, optional, default False
             Whether to print the epoch number to stdout
+        algorithm : str, optional, default "online"
+            The training algorithm. "online" updates the weights after
+            every batch. "batch" uses the batch algorithm, which sets the
+            weights to the neighborhood-weighted mean of the data once per
+            epoch. Not every learner supports the batch algorithm.
+        n_jobs : int, optional, default 1
+            The number of threads to use. If this is larger than 1, each
+            batch is split into n_jobs shards, for which the activations
+            and the partial updates are calculated in parallel, and which
+            are summed into a single update of the weights. Because numpy
+            releases the GIL, this uses multiple cores. Batch sizes should
+            be a lot larger than n_jobs for this to be effective.
+        chunk_size : int, optional, default 100000
+            The number of rows to read at the same time from a
+            memory-mapped array. Chunks are visited in a random order, and
+            the rows in each chunk are shuffled.
 
         """
+        # Check the algorithm before any state is changed, so that a
+        # mistaken call does not reset a trained learner.
+        if algorithm not in ("online", "batch"):
+            raise ValueError("Unknown algorithm: {0}, expected 'online' or "
+                             "'batch'".format(algorithm))
+        if algorithm not in self.algorithms:
+            name = self.__class__.__name__
+            raise ValueError("{0} does not support the {1} "
+                             "algorithm.".format(name, algorithm))
+
+        if algorithm == "online":
+            epoch_function = self._epoch
+        else:
+            epoch_function = self._batch_epoch
+            # The batch algorithm updates its parameters once per epoch.
+            updates_epoch = 1
+
+        if not isinstance(X, np.ndarray) or isinstance(X, np.memmap):
+            X = ChunkReader(X, chunk_size, self.dtype)
+
+        # The weights change, so an index or inference form over them is
+        # no longer valid.
+        self.index = None
+        self.inference = None
+
         if self.data_dimensionality is None:
             self.data_dimensionality = X.shape[-1]
             self.weights = np.zeros((self.num_neurons,
-                                     self.data_dimensionality))
-        X = self._check_input(X)
+                                     self.data_dimensionality),
+                                    dtype=self.dtype)
+        if not isinstance(X, ChunkReader):
+            X = self._check_input(X)
         if not self.trained or refit:
             X = self._init_weights(X)
         else:
             if self.scaler is not None:
-                self.weights = self.scaler.transform(self.weights)
+                # The weights are moved to the space of the scaler, so the
+                # data is scaled as well, whether it is streamed or not.
+                self.scaler.transform(self.weights, out=self.weights)
+                if isinstance(X, ChunkReader):
+                    X.transform = self.scaler.transform
+                else:
+                    X = self.scaler.transform(np.asarray(X,
+                                                         dtype=self.dtype))
 
         if updates_epoch is None:
-            X_len = X.shape[0]
+            X_len = len(X)
             updates_epoch = np.min([50, X_len // batch_size])
 
         constants = self._pre_train(stop_param_updates,
                                     num_epochs,
                                     updates_epoch)
         start = time.time()
-        for epoch in tqdm(range(num_epochs), disable=not show_epoch):
-            logger.info("Epoch {0} of {1}".format(epoch+1, num_epochs))
-
-            self._epoch(X,
-                        epoch,
-                        batch_size,
-                        updates_epoch,
-                        constants,
-                        show_progressbar)
+        if n_jobs > 1:
+            self._pool = ThreadPoolExecutor(n_jobs)
+            self._n_jobs = n_jobs
+        try:
+            for epoch in tqdm(range(num_epochs), disable=not show_epoch):
+                logger.info("Epoch {0} of {1}".format(epoch+1, num_epochs))
+
+                epoch_function(X,
+                               epoch,
+                               batch_size,
+                               updates_epoch,
+                               constants,
+                               show_progressbar)
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+                self._n_jobs = 1
 
         self.trained = True
         if self.scaler is not None:
-            self.weights = self.scaler.inverse_transform(self.weights)
+            self.scaler.inverse_transform(self.weights, out=self.weights)
         logger.info("Total train time: {0}".format(time.time() - start))
 
     def _init_weights(self,
                       X):
         """Set the weights and normalize data before starting training."""
-        X = np.asarray(X, dtype=np.float64)
+        if isinstance(X, ChunkReader):
+            return self._init_weights_streamed(X)
+
+        X = np.asarray(X, dtype=self.dtype)
 
         if self.scaler is not None:
             X = self.scaler.fit_transform(X)
 
         if self.initializer is not None:
-            self.weights = self.initializer(X, self.num_neurons)
+            self.weights = np.asarray(self.initializer(X, self.num_neurons),
+                                      dtype=self.dtype)
+
+        for v in self.params.values():
+            v['value'] = v['orig']
+
+        return X
+
+    def _init_weights_streamed(self, X):
+        """
+        Set the weights and fit the scaler in a single pass over the data.
+
+        Because scaling does not change the order of the values of a
+        feature, the range of the scaled data is the scaled range of the
+        data. The initializer is therefore called on the scaled minimum
+        and maximum of each feature, instead of on the data itself.
+        """
+        min_val, max_val = None, None
+        length = 0
+        for chunk in X.chunks():
+            chunk = self._check_input(chunk)
+            if self.scaler is not None:
+                if length:
+                    self.scaler.partial_fit(chunk)
+                else:
+                    self.scaler.fit(chunk)
+            if min_val is None:
+                min_val, max_val = chunk.min(0), chunk.max(0)
+            else:
+                min_val = np.minimum(min_val, chunk.min(0))
+                max_val = np.maximum(max_val, chunk.max(0))
+            length += len(chunk)
+
+        X._length = length
+        bounds = np.stack([min_val, max_val])
+        if self.scaler is not None:
+            X.transform = self.scaler.transform
+            bounds = self.scaler.transform(bounds)
+
+        if self.initializer is not None:
+            self.weights = np.asarray(self.initializer(bounds,
+                                                       self.num_neurons),
+                                      dtype=self.dtype)
 
         for v in self.params.values():
             v['value'] = v['orig']
@@ -194,6 +333,70 @@ class Base(object):
 
         return constants
 
+    def partial_fit(self, X, batch_size=1, show_progressbar=False):
+        """
+        Update the learner with a chunk of data.
+
+        Unlike fit, this does not reinitialize the weights or the parameters
+        of a trained learner, so that it can follow data which arrives over
+        time. The first call initializes the weights from the chunk. The
+        learning rate and influence stay at their current values, and the
+        statistics of the scaler are updated with the chunk.
+
+        Parameters
+        ----------
+        X : numpy array
+            A chunk of data.
+        batch_size : int, optional, default 1
+            The batch size to use.
+        show_progressbar : bool
+            Whether to show a progressbar.
+
+        Returns
+        -------
+        self : Base
+            The learner itself.
+
+        """
+        X = np.asarray(X)
+        if self.data_dimensionality is None:
+            self.data_dimensionality = X.shape[-1]
+            self.weights = np.zeros((self.num_neurons,
+                                     self.data_dimensionality),
+                                    dtype=self.dtype)
+        X = self._check_input(X)
+
+        if not self.trained:
+            X = self._init_weights(X)
+        elif self.scaler is not None:
+            # The weights are stored unscaled, so they can be scaled with
+            # the updated statistics.
+            self.scaler.partial_fit(X)
+            X = self.scaler.transform(X)
+            self.scaler.transform(self.weights, out=self.weights)
+        X = np.asarray(X, dtype=self.dtype)
+        self.weights = np.asarray(self.weights, dtype=self.dtype)
+
+        # The weights change, so an index or inference form over them is
+        # no longer valid.
+        self.index = None
+        self.inference = None
+        self._partial_epoch(X, batch_size, show_progressbar)
+
+        self.trained = True
+        if self.scaler is not None:
+            self.scaler.inverse_transform(self.weights, out=self.weights)
+        return self
+
+    def _partial_epoch(self, X, batch_size, show_progressbar):
+        """Present a chunk of data once, without changing the parameters."""
+        influences = self._calculate_influence(self.params['infl']['value'])
+        influences = influences * float(self.params['lr']['value'])
+
+        X_ = self._create_batches(X, batch_size)
+        for x in tqdm(X_, disable=not show_progressbar):
+            self._propagate(x, influences)
+
     def fit_predict(self,
                     X,
                     num_epochs=10,
@@ -262,9 +465,9 @@ class Base(object):
         """
         # Create batches
         X_ = self._create_batches(X, batch_size)
-        X_len = np.prod(X.shape[:-1])
+        X_len = len(X)
 
-        update_step = np.ceil(X_.shape[0] / updates_epoch)
+        update_step = np.ceil(np.ceil(X_len / batch_size) / updates_epoch)
 
         # Initialize the previous activation
         prev = self._init_prev(X_)
@@ -273,16 +476,6 @@ class Base(object):
         # Iterate over the training data
         for idx, x in enumerate(tqdm(X_, disable=not show_progressbar)):
 
-            # Our batches are padded, so we need to
-            # make sure we know when we hit the padding
-            # so we don't inadvertently learn zeroes.
-            diff = X_len - (idx * batch_size)
-            if diff and diff < batch_size:
-                x = x[:diff]
-                # Prev_activation may be None
-                if prev is not None:
-                    prev = prev[:diff]
-
             # If we hit an update step, perform an update.
             if idx % update_step == 0:
                 influences = self._update_params(constants)
@@ -292,13 +485,24 @@ class Base(object):
                                    influences,
                                    prev_activation=prev)
 
+    def _batch_epoch(self,
+                     X,
+                     epoch_idx,
+                     batch_size,
+                     updates_epoch,
+                     constants,
+                     show_progressbar):
+        """Run a single epoch of the batch algorithm."""
+        raise ValueError("{0} does not support the batch "
+                         "algorithm.".format(self.__class__.__name__))
+
     def _update_params(self, constants):
         """Update params and return new influence."""
         for k, v in constants.items():
             self.params[k]['value'] *= v
 
         influence = self._calculate_influence(self.params['infl']['value'])
-        return influence * self.params['lr']['value']
+        return influence * float(self.params['lr']['value'])
 
     def _init_prev(self, x):
         """Initialize recurrent SOMs."""
@@ -312,35 +516,72 @@ class Base(object):
         """
         Create batches out of a sequence of data.
 
-        This function will append zeros to the end of your data to ensure that
-        all batches are even-sized. These are masked out during training.
+        The batches are views of the data, or, if the data is shuffled, are
+        gathered into a reused buffer, see Batches. The last batch is
+        shorter if the batch size does not divide the length of the data.
+        Streamed data is batched by the ChunkReader.
         """
-        if shuffle_data:
-            X = shuffle(X)
-
-        if batch_size > X.shape[0]:
-            batch_size = X.shape[0]
+        if isinstance(X, ChunkReader):
+            return X.batches(batch_size, shuffle_data)
 
-        max_x = int(np.ceil(X.shape[0] / batch_size))
-        X = np.resize(X, (max_x, batch_size, X.shape[-1]))
-
-        return X
+        X = X.reshape(-1, X.shape[-1])
+        return Batches(X, batch_size, shuffle_data)
 
     def _propagate(self, x, influences, **kwargs):
         """Propagate a single batch of examples through the network."""
-        activation, difference_x = self.forward(x)
-        update = self.backward(difference_x, influences, activation)
-        # If batch size is 1 we can leave out the call to mean.
-        if update.shape[0] == 1:
-            self.weights += update[0]
-        else:
-            self.weights += update.mean(0)
+        results = self._sharded(lambda shard: self._partial_propagate(
+                                    shard, influences), x)
+        activation, numerator, denominator = zip(*results)
+        self.weights += self._combine_update(numerator,
+                                             denominator,
+                                             self.weights,
+                                             x.shape[0])
+
+        return np.concatenate(activation)
+
+    def _partial_propagate(self, x, influences):
+        """
+        Propagate a shard of a batch, without updating the weights.
+
+        Returns the activations of the shard, and the sums which together
+        make up the update of the weights, see _accumulate.
+        """
+        activation = self.forward(x)
+        bmu = self._get_bmu(activation)
+        numerator, denominator = self._accumulate(x, influences[bmu])
 
-        return activation
+        return activation, numerator, denominator
+
+    def _sharded(self, function, X):
+        """
+        Apply a function to shards of X.
+
+        If a thread pool is active, X is split into one contiguous shard
+        per thread, and the function is applied to the shards in parallel.
+        Otherwise, the function is applied to X as a whole.
+
+        Parameters
+        ----------
+        function : function
+            The function to apply.
+        X : numpy array
+            The data to split into shards.
+
+        Returns
+        -------
+        results : list
+            The result of the function on each shard.
+
+        """
+        if self._pool is None or len(X) < 2:
+            return [function(X)]
+
+        num_shards = min(self._n_jobs, len(X))
+        return list(self._pool.map(function, np.array_split(X, num_shards)))
 
     def forward(self, x, **kwargs):
         """
-        Get the best matching neurons, and the difference between inputs.
+        Get the activation of each neuron to each input.
 
         Note: it might seem like this function can be replaced by a call to
         distance function. This is only true for the regular SOM. other
@@ -354,39 +595,118 @@ class Base(object):
 
         Returns
         -------
-        matrices : tuple of matrices.
-            A tuple containing the activations and differences between
-            neurons and input, respectively.
+        activations : numpy array
+            A (batch_size * neurons) matrix containing the activation of each
+            neuron to each input.
+
+        """
+        return self._input_distance(x)
 
+    def _input_distance(self, x):
         """
+        Calculate the distance between the input and the weights.
+
+        If an inference form was prepared with prepare_inference, the
+        distance is calculated in the space of the scaler.
+        """
+        if self.inference is not None:
+            return self.inference.distance(x)
         return self.distance_function(x, self.weights)
 
-    def backward(self, diff_x, influences, activations, **kwargs):
+    def _mean_update(self, x, influence, weights):
         """
-        Backward pass through the network, including update.
+        Calculate the mean of influence * (x - weights) over a batch.
+
+        The update is expanded as (influence.T * x) - (sum(influence) *
+        weights), which avoids creating the (batch_size, neurons, dim)
+        tensor of differences between the input and the weights.
 
         Parameters
         ----------
-        diff_x : numpy array
-            A matrix containing the differences between the input and neurons.
-        influences : numpy array
-            A matrix containing the influence each neuron has on each
-            other neuron. This is used to calculate the updates.
-        activations : numpy array
-            The activations each neuron has to each data point. This is used
-            to calculate the BMU.
+        x : numpy array
+            The input data, dim (batch_size * dim).
+        influence : numpy array or SparseInfluence
+            The influence of each input on each neuron,
+            dim (batch_size * neurons). If the influence is sparse, only
+            the differences for the neurons it contains are calculated.
+        weights : numpy array
+            The weights to update, dim (neurons * dim).
 
         Returns
         -------
         update : numpy array
-            A numpy array containing the updates to the neurons.
+            The update to the weights, dim (neurons * dim).
 
         """
-        bmu = self._get_bmu(activations)
-        influence = influences[bmu]
-        update = np.multiply(diff_x, influence)
+        numerator, denominator = self._accumulate(x, influence)
+        return self._combine_update([numerator],
+                                    [denominator],
+                                    weights,
+                                    x.shape[0])
+
+    def _combine_update(self, numerators, denominators, weights, n):
+        """
+        Combine the sums of one or more shards of a batch into an update.
+
+        Parameters
+        ----------
+        numerators : list of numpy arrays
+            The sum of influence * x of each shard, see _accumulate. The
+            first array may be overwritten.
+        denominators : list of numpy arrays
+            The sum of the influence of each shard, see _accumulate.
+        weights : numpy array
+            The weights to update, dim (neurons * dim).
+        n : int
+            The number of data points in the batch.
+
+        Returns
+        -------
+        update : numpy array
+            The mean update to the weights, dim (neurons * dim).
+
+        """
+        update = sum(numerators[1:], numerators[0])
+        update -= sum(denominators)[:, None] * weights
+        update /= n
         return update
 
+    def _accumulate(self, x, influence):
+        """
+        Sum the influence on each neuron, and the inputs weighted by it.
+
+        These sums can be calculated separately for parts of a batch and
+        added afterwards, which is used to calculate updates in parallel.
+
+        Parameters
+        ----------
+        x : numpy array
+            The input data, dim (batch_size * dim).
+        influence : numpy array or SparseInfluence
+            The influence of each input on each neuron,
+            dim (batch_size * neurons).
+
+        Returns
+        -------
+        sums : tuple of numpy arrays
+            The sum of influence * x, dim (neurons * dim), and the sum of
+            the influence, dim (neurons,), for each neuron.
+
+        """
+        if isinstance(influence, SparseInfluence):
+            rows, neurons, values = influence
+            numerator = np.zeros((self.num_neurons, x.shape[1]),
+                                 dtype=x.dtype)
+            scatter_add(numerator,
+                        neurons,
+                        lambda b: x[rows[b]] * values[b, None])
+            denominator = np.bincount(neurons,
+                                      values,
+                                      minlength=self.num_neurons)
+            return numerator, denominator.astype(x.dtype)
+
+        return influence.T.dot(x), influence.sum(0)
+
     def distance_function(self, x, weights):
         """
         Calculate euclidean distance between a batch of input data and weights.
@@ -400,15 +720,12 @@ class Base(object):
 
         Returns
         -------
-        matrices : tuple of matrices
-            The first matrix is a (batch_size * neurons) matrix of
-            activation values, containing the response of each neuron
-            to each input
-            The second matrix is a (batch_size * neurons) matrix containing
-            the difference between euch neuron and each input.
+        distances : numpy array
+            A (batch_size * neurons) matrix containing the distance from
+            each input to each neuron.
 
         """
-        return euclidean(x, weights)
+        return euclidean_distance(x, weights)
 
     def _check_input(self, X):
         """
@@ -431,7 +748,12 @@ class Base(object):
                                                    self.data_dimensionality))
         return X
 
-    def transform(self, X, batch_size=100, show_progressbar=False):
+    def transform(self,
+                  X,
+                  batch_size=100,
+                  show_progressbar=False,
+                  n_jobs=1,
+                  out=None):
         """
         Transform input to a distance matrix by measuring the L2 distance.
 
@@ -444,6 +766,15 @@ class Base(object):
             transformation in stateful, i.e. sequential SOMs.
         show_progressbar : bool
             Whether to show a progressbar during transformation.
+        n_jobs : int, optional, default 1
+            The number of threads to use. The batches are independent, so
+            they are divided over the threads, and because numpy releases
+            the GIL, this uses multiple cores. Sequential SOMs process
+            their batches in order, and ignore this.
+        out : numpy array, optional, default None
+            The array to write the result to, dim (len(X) * num_neurons).
+            This can be a memory-mapped array, for results which do not fit
+            in memory. If this is None, a new array is allocated.
 
         Returns
         -------
@@ -454,24 +785,158 @@ class Base(object):
 
         """
         X = self._check_input(X)
+        out = self._check_output(out, (X.shape[0], self.num_neurons))
+
+        for rows, activation in self._forward_batches(X,
+                                                      batch_size,
+                                                      show_progressbar,
+                                                      n_jobs):
+            out[rows] = activation
+
+        return out
+
+    def _check_output(self, out, shape, dtype=None):
+        """Allocate an output array, or check the shape of a given one."""
+        if out is None:
+            return np.empty(shape, dtype=dtype or self.dtype)
+        if out.shape != shape:
+            raise ValueError("out should have shape {0}, "
+                             "has shape {1}".format(shape, out.shape))
+        return out
+
+    def _forward_batches(self,
+                         X,
+                         batch_size,
+                         show_progressbar=False,
+                         n_jobs=1,
+                         function=None):
+        """
+        Calculate the activations of the data batch by batch.
 
+        Parameters
+        ----------
+        X : numpy array
+            The input data.
+        batch_size : int
+            The batch size.
+        show_progressbar : bool
+            Whether to show a progressbar.
+        n_jobs : int, optional, default 1
+            The number of threads over which the batches are divided.
+        function : callable, optional, default None
+            A function which is applied to the activation of each batch in
+            the thread which calculated it, e.g. to find the BMUs. If this
+            is None, the activation itself is yielded.
+
+        Yields
+        ------
+        rows : slice or numpy array
+            The rows of X in the batch.
+        activation : numpy array
+            The activation of each neuron to each row in the batch, or the
+            result of function.
+
+        """
         batched = self._create_batches(X, batch_size, shuffle_data=False)
 
-        activations = []
-        prev = self._init_prev(batched)
+        def process(x):
+            activation = self.forward(x.astype(self.dtype, copy=False))
+            if function is not None:
+                activation = function(activation)
+            return len(x), activation
 
-        for x in tqdm(batched, disable=not show_progressbar):
-            prev = self.forward(x, prev_activation=prev)[0]
-            activations.extend(prev)
+        batched = tqdm(batched, disable=not show_progressbar)
+        start = 0
+        for length, activation in ordered_map(process, batched, n_jobs):
+            yield slice(start, start+length), activation
+            start += length
+
+    def build_index(self, n_lists=None, n_probe=1):
+        """
+        Build an approximate nearest neighbor index over the weights.
 
-        activations = np.asarray(activations, dtype=np.float64)
-        activations = activations[:X.shape[0]]
-        return activations.reshape(X.shape[0], self.num_neurons)
+        Once an index is built, predict and quantization_error find the
+        BMU through the index instead of calculating the distance to every
+        neuron. This is a lot faster for large maps, but can return a
+        neuron which is not the true BMU. The index is removed when the
+        learner is fit again. If an inference form was prepared with
+        prepare_inference, the index uses the same distance.
 
-    def predict(self, X, batch_size=1, show_progressbar=False):
+        Parameters
+        ----------
+        n_lists : int, optional, default None
+            The number of lists to divide the neurons into. If this is None,
+            the square root of the number of neurons is used.
+        n_probe : int, optional, default 1
+            The number of lists to search for each data point. This trades
+            speed for recall, and can be changed later through index.n_probe.
+            If n_probe is equal to n_lists, the index is exact.
+
+        Returns
+        -------
+        index : InvertedIndex
+            The index.
+
+        """
+        if not self.trained:
+            raise ValueError("Please fit the learner before building an "
+                             "index.")
+        if self.argfunc != 'argmin':
+            raise ValueError("An index can only be built for learners "
+                             "whose BMU is the closest neuron.")
+        self.index = InvertedIndex(self.weights,
+                                   n_lists,
+                                   n_probe,
+                                   metric=self._metric())
+        return self.index
+
+    def _metric(self):
+        """Get the metric of the inference form, if one was prepared."""
+        if self.inference is None:
+            return None
+        return self.inference.metric
+
+    def prepare_inference(self):
+        """
+        Prepare the weights for inference in the space of the scaler.
+
+        The weights are trained on scaled data, but are stored in the space
+        of the data, so transform, predict and the other inference methods
+        measure the distance in the space of the data. Once an inference
+        form is prepared, they measure the distance in the space of the
+        scaler instead, which is the distance used during training, without
+        scaling the data. The weights are prepared once, so that the norms
+        of the weights are not recalculated for each batch, which also
+        speeds up learners without a scaler. The inference form is removed
+        when the learner is fit again. If an index was built with
+        build_index, it is built again with the same distance.
+
+        Returns
+        -------
+        inference : InferenceForm
+            The inference form.
+
+        """
+        if not self.trained:
+            raise ValueError("Please fit the learner before preparing it "
+                             "for inference.")
+        self.inference = InferenceForm(self.weights, self.scaler)
+        if self.index is not None:
+            self.build_index(self.index.n_lists, self.index.n_probe)
+        return self.inference
+
+    def predict(self,
+                X,
+                batch_size=1,
+                show_progressbar=False,
+                n_jobs=1,
+                out=None):
         """
         Predict the BMU for each input data.
 
+        The BMUs are found batch by batch, so the distance matrix of the
+        whole input is never allocated.
+
         Parameters
         ----------
         X : numpy array.
@@ -481,6 +946,11 @@ class Base(object):
             in stateful, i.e. sequential SOMs.
         show_progressbar : bool
             Whether to show a progressbar during prediction.
+        n_jobs : int, optional, default 1
+            The number of threads to use, see transform.
+        out : numpy array, optional, default None
+            The array to write the result to, dim (len(X),). If this is
+            None, a new array is allocated.
 
         Returns
         -------
@@ -488,12 +958,86 @@ class Base(object):
             An array containing the BMU for each input data point.
 
         """
-        dist = self.transform(X, batch_size, show_progressbar)
-        res = dist.__getattribute__(self.argfunc)(1)
+        X = self._check_input(X)
+        out = self._check_output(out, (X.shape[0],), np.int64)
+        if self.index is not None:
+            X = X.astype(self.dtype, copy=False)
+            out[:] = self.index.query(X)[1][:, 0]
+            return out
+
+        def bmu(activation):
+            return getattr(activation, self.argfunc)(1)
+
+        for rows, bmus in self._forward_batches(X,
+                                                batch_size,
+                                                show_progressbar,
+                                                n_jobs,
+                                                bmu):
+            out[rows] = bmus
+
+        return out
+
+    def top_k_bmus(self,
+                   X,
+                   k=2,
+                   batch_size=100,
+                   show_progressbar=False,
+                   n_jobs=1):
+        """
+        Get the k best matching units for each input data.
 
-        return res
+        The activations are calculated in batches, and only the k best
+        neurons of each batch are kept, so the full activation matrix is
+        never allocated. If an index was built with build_index, the index
+        is used instead.
+
+        Parameters
+        ----------
+        X : numpy array.
+            The input data.
+        k : int, optional, default 2
+            The number of BMUs to return.
+        batch_size : int, optional, default 100
+            The batch size to use. This may affect the result in stateful,
+            i.e. sequential SOMs.
+        show_progressbar : bool
+            Whether to show a progressbar.
+        n_jobs : int, optional, default 1
+            The number of threads to use, see transform.
+
+        Returns
+        -------
+        bmus : numpy array
+            The k best matching units of each data point, from best to
+            worst, dim (len(X) * k).
+        activations : numpy array
+            The activation of each of these units, dim (len(X) * k).
 
-    def quantization_error(self, X, batch_size=1):
+        """
+        X = self._check_input(X)
+        k = min(k, self.num_neurons)
+        if self.index is not None:
+            X = X.astype(self.dtype, copy=False)
+            activations, bmus = self.index.query(X, k)
+            return bmus, activations
+
+        largest = self.argfunc == 'argmax'
+        bmus = np.empty((X.shape[0], k), dtype=np.int64)
+        activations = np.empty((X.shape[0], k), dtype=self.dtype)
+
+        def best(activation):
+            return top_k(activation, k, largest)
+
+        for rows, (neurons, values) in self._forward_batches(X,
+                                                             batch_size,
+                                                             show_progressbar,
+                                                             n_jobs,
+                                                             best):
+            bmus[rows], activations[rows] = neurons, values
+
+        return bmus, activations
+
+    def quantization_error(self, X, batch_size=1, n_jobs=1):
         """
         Calculate the quantization error.
 
@@ -506,6 +1050,8 @@ class Base(object):
             The input data.
         batch_size : int
             The batch size to use for processing.
+        n_jobs : int, optional, default 1
+            The number of threads to use, see transform.
 
         Returns
         -------
@@ -513,8 +1059,20 @@ class Base(object):
             The error for each data point.
 
         """
-        dist = self.transform(X, batch_size)
-        res = dist.__getattribute__(self.valfunc)(1)
+        X = self._check_input(X)
+        if self.index is not None:
+            X = X.astype(self.dtype, copy=False)
+            return self.index.query(X)[0][:, 0]
+
+        def error(activation):
+            return getattr(activation, self.valfunc)(1)
+
+        res = np.empty(X.shape[0], dtype=self.dtype)
+        for rows, errors in self._forward_batches(X,
+                                                  batch_size,
+                                                  n_jobs=n_jobs,
+                                                  function=error):
+            res[rows] = errors
 
         return res
 
@@ -538,7 +1096,7 @@ class Base(object):
             Input data.
         identities : list
             A list of symbolic identities associated with each input.
-            We enpect this list to be as long as the input data.
+            We expect this list to be as long as the input data.
         max_len : int, optional, default 10
             The maximum length to attempt to find. Raising this increases
             memory use.
@@ -555,84 +1113,70 @@ class Base(object):
         receptive_fields : dict
             A dictionary mapping from the neuron id to the found sequences
             for that neuron. The sequences are represented as lists of
-            symbols from identities.
-
-        """
-        receptive_fields = defaultdict(list)
-
-        predictions = self.predict(X)
+            symbols from identities, starting at the most recent symbol.
 
-        if len(predictions) != len(identities):
-            raise ValueError("X and identities are not the same length: "
-                             "{0} and {1}".format(len(predictions),
-                                                  len(identities)))
+        See Also
+        --------
+        ReceptiveField : counts the receptive field chunk by chunk, for
+            corpora which do not fit in memory.
 
-        for idx, p in enumerate(predictions.tolist()):
-            receptive_fields[p].append(identities[idx+1 - max_len:idx+1])
-
-        rec = {}
-
-        for k, v in receptive_fields.items():
-            # if there's only one sequence, we don't know
-            # anything abouw how salient it is.
-            seq = []
-            if len(v) <= 1:
-                continue
-            else:
-                for x in reversed(list(zip(*v))):
-                    x = Counter(x)
-                    if x.most_common(1)[0][1] / sum(x.values()) > threshold:
-                        seq.append(x.most_common(1)[0][0])
-                    else:
-                        rec[k] = seq
-                        break
-
-        return rec
+        """
+        predictions = self.predict(X, batch_size)
+        field = ReceptiveField(max_len).update(predictions, identities)
+        return field.fields(threshold)
 
     @classmethod
-    def load(cls, path):
+    def load(cls, path, mmap=False):
         """
-        Load a SOM from a JSON file saved with this package.
+        Load a learner from a file saved with this package.
 
         Parameters
         ----------
         path : str
-            The path to the JSON file.
+            The path to the file.
+        mmap : bool, optional, default False
+            Whether to memory-map the weights from the file, instead of
+            reading them into memory. This makes loading almost instant,
+            and lets processes which load the same model share memory.
 
         Returns
         -------
         s : cls
-            A som of the specified class.
+            A learner of the specified class.
 
         """
-        data = json.load(open(path))
+        data = load_model(path, mmap)
 
         weights = data['weights']
-        weights = np.asarray(weights, dtype=np.float64)
 
         s = cls(data['num_neurons'],
                 data['data_dimensionality'],
-                data['params']['lr']['orig'],
-                neighborhood=data['params']['infl']['orig'],
+                data['params'],
                 valfunc=data['valfunc'],
                 argfunc=data['argfunc'],
-                lr_lambda=data['params']['lr']['factor'],
-                nb_lambda=data['params']['nb']['factor'])
+                dtype=data.get('dtype', np.float64))
 
-        s.weights = weights
+        s.weights = np.asarray(weights, dtype=s.dtype)
         s.trained = True
 
         return s
 
     def save(self, path):
-        """Save a SOM to a JSON file."""
+        """
+        Save a learner to a binary file.
+
+        The weights are stored as raw arrays, which can be memory-mapped
+        by load, while all other parameters are stored as a JSON header.
+        """
         to_save = {}
+        arrays = {}
         for x in self.param_names:
             attr = self.__getattribute__(x)
-            if type(attr) == np.ndarray:
-                attr = [[float(x) for x in row] for row in attr]
+            if isinstance(attr, np.ndarray):
+                arrays[x] = attr
+                continue
             elif isinstance(attr, types.FunctionType):
                 attr = attr.__name__
             to_save[x] = attr
 
-        json.dump(to_save, open(path, 'w'))
+        save_model(path, to_save, arrays)
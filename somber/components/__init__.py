@@ -1,5 +1,20 @@
 """Components, helper functions, etc."""
 from .initializers import range_initialization
 from .utilities import Scaler
+from .grid import (Grid,
+                   SeparableInfluence,
+                   TruncatedInfluence,
+                   grid_coordinates)
+from .index import InvertedIndex
+from .receptive import ReceptiveField
+from .inference import InferenceForm
 
-__all__ = ["Scaler", "range_initialization"]
+__all__ = ["Scaler",
+           "range_initialization",
+           "Grid",
+           "SeparableInfluence",
+           "TruncatedInfluence",
+           "grid_coordinates",
+           "InvertedIndex",
+           "ReceptiveField",
+           "InferenceForm"]
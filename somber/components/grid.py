@@ -0,0 +1,494 @@
+"""Helpers for the topology of SOM grids."""
+import numpy as np
+
+from collections import namedtuple
+from numpy.lib.stride_tricks import as_strided
+from .utilities import scatter_add, array_cache
+
+
+SparseInfluence = namedtuple("SparseInfluence", ["rows", "neurons", "values"])
+
+
+def grid_coordinates(map_dimensions):
+    """
+    Calculate the grid coordinates of each neuron.
+
+    Parameters
+    ----------
+    map_dimensions : tuple
+        The dimensions of the map.
+
+    Returns
+    -------
+    coordinates : numpy array
+        An array of shape (num_neurons, len(map_dimensions)) containing the
+        position of each neuron on the grid.
+
+    """
+    num_neurons = int(np.prod(map_dimensions))
+    return np.stack(np.unravel_index(np.arange(num_neurons),
+                                     map_dimensions), 1)
+
+
+def grid_offsets(map_dimensions, radius):
+    """
+    Get all offsets on a grid within a box of some radius.
+
+    The box never extends further than the size of the map along each axis.
+
+    Parameters
+    ----------
+    map_dimensions : tuple
+        The dimensions of the map.
+    radius : float
+        The radius of the box.
+
+    Returns
+    -------
+    offsets : tuple of numpy arrays
+        The offsets, dim (num_offsets, len(map_dimensions)), and their
+        squared length.
+
+    """
+    radii = np.minimum(int(np.floor(radius)),
+                       np.asarray(map_dimensions) - 1)
+    axes = [np.arange(-r, r+1) for r in radii]
+    offsets = np.stack(np.meshgrid(*axes, indexing='ij'), -1)
+    offsets = offsets.reshape(-1, len(axes))
+    return offsets, (offsets ** 2).sum(1)
+
+
+@array_cache()
+def gaussian_profile(width, sigma, dtype):
+    """
+    Calculate the gaussian of each distance between positions on an axis.
+
+    The distance between two positions on an axis lies between
+    -(width - 1) and width - 1, so the influence of each position on all
+    other positions is a slice of a single profile of 2 * width - 1
+    values: the influence of position c is
+    profile[width - 1 - c:2 * width - 1 - c].
+
+    Parameters
+    ----------
+    width : int
+        The number of positions on the axis.
+    sigma : float
+        The width of the gaussian.
+    dtype : numpy dtype
+        The floating point type of the profile.
+
+    Returns
+    -------
+    profile : numpy array
+        The influence at each distance from -(width - 1) to width - 1,
+        dim (2 * width - 1,).
+
+    """
+    distance = np.arange(1 - width, width) ** 2
+    profile = np.exp(-distance / (sigma ** 2)).astype(dtype)
+    profile.flags.writeable = False
+    return profile
+
+
+def profile_rows(profile):
+    """
+    Get a view of a profile with the influence of each position in a row.
+
+    Row c of the view is the influence of position c on each position on
+    the axis. The rows overlap in memory, so the view takes no space.
+
+    Parameters
+    ----------
+    profile : numpy array
+        A profile as returned by gaussian_profile, dim (2 * width - 1,).
+
+    Returns
+    -------
+    rows : numpy array
+        A read-only view, dim (width * width).
+
+    """
+    width = (len(profile) + 1) // 2
+    stride = profile.strides[0]
+    # Start at the last window, and step backwards through the profile.
+    last = profile[width-1:]
+    rows = as_strided(last, shape=(width, width), strides=(-stride, stride))
+    # The rows overlap, so writing to one would change the others.
+    rows.flags.writeable = False
+    return rows
+
+
+@array_cache()
+def gaussian_stencil(map_dimensions, sigma, truncate, dtype):
+    """
+    Calculate the offsets and influence of a truncated gaussian.
+
+    Parameters
+    ----------
+    map_dimensions : tuple
+        The dimensions of the map.
+    sigma : float
+        The width of the gaussian.
+    truncate : float
+        The number of sigmas after which the gaussian is cut off.
+    dtype : numpy dtype
+        The floating point type of the influence.
+
+    Returns
+    -------
+    stencil : tuple of numpy arrays
+        The offsets within truncate * sigma, dim (num_offsets,
+        len(map_dimensions)), and the influence at each offset.
+
+    """
+    cutoff = truncate * sigma
+    offsets, distance = grid_offsets(map_dimensions, cutoff)
+    mask = distance <= cutoff ** 2
+
+    offsets = offsets[mask]
+    values = np.exp(-distance[mask] / (sigma ** 2)).astype(dtype)
+    offsets.flags.writeable = False
+    values.flags.writeable = False
+    return offsets, values
+
+
+class Grid(object):
+    """
+    The topology of a SOM.
+
+    Because the squared distance between two neurons on the grid is a sum
+    over the axes of the map, the grid only needs to store the coordinates
+    of each neuron, and not the distance from each neuron to each other
+    neuron. This makes the memory use of the grid linear in the number of
+    neurons.
+
+    Parameters
+    ----------
+    map_dimensions : tuple
+        The dimensions of the map.
+
+    Attributes
+    ----------
+    coordinates : numpy array
+        The position of each neuron on the grid,
+        dim (num_neurons, len(map_dimensions)).
+
+    """
+
+    def __init__(self, map_dimensions):
+        """Calculate the coordinates of each neuron."""
+        self.map_dimensions = tuple(int(x) for x in map_dimensions)
+        self.num_neurons = int(np.prod(self.map_dimensions))
+        self.coordinates = grid_coordinates(self.map_dimensions)
+
+    def distance(self, x, y):
+        """
+        Calculate the squared grid distance between pairs of neurons.
+
+        Parameters
+        ----------
+        x : numpy array
+            The indices of the first neurons.
+        y : numpy array
+            The indices of the second neurons.
+
+        Returns
+        -------
+        distance : numpy array
+            The squared distance on the grid between each x and y.
+
+        """
+        diff = self.coordinates[x] - self.coordinates[y]
+        return (diff ** 2).sum(-1)
+
+    def distance_grid(self):
+        """
+        Calculate the dense distance grid.
+
+        This allocates num_neurons ** 2 values, and is only provided for
+        inspection of small maps.
+
+        Returns
+        -------
+        distance_grid : numpy array
+            The squared distance from each neuron to each position on the
+            map, dim (num_neurons, *map_dimensions).
+
+        """
+        diff = self.coordinates[:, None, :] - self.coordinates[None, :, :]
+        distance = (diff ** 2).sum(-1)
+        return distance.reshape((self.num_neurons,) + self.map_dimensions)
+
+    def neighbors(self, distance):
+        """
+        Get all pairs of neurons within some grid distance of each other.
+
+        Parameters
+        ----------
+        distance : float
+            The maximum squared grid distance between two neighbors.
+
+        Returns
+        -------
+        neighbors : tuple of numpy arrays
+            The indices of the first and second neuron of each pair,
+            sorted by the first and then the second neuron. A neuron is not
+            its own neighbor.
+
+        """
+        offsets, squared = grid_offsets(self.map_dimensions,
+                                        np.sqrt(distance))
+        offsets = offsets[(squared > 0) & (squared <= distance)]
+
+        x, y = [], []
+        for offset in offsets:
+            other = self.coordinates + offset
+            valid = np.all((other >= 0) & (other < self.map_dimensions), 1)
+            x.append(np.flatnonzero(valid))
+            y.append(np.ravel_multi_index(other[valid].T,
+                                          self.map_dimensions))
+
+        if not x:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        x, y = np.concatenate(x), np.concatenate(y)
+        order = np.lexsort((y, x))
+        return x[order], y[order]
+
+    def influence(self, sigma, dtype=np.float64, cached=True):
+        """
+        Get the gaussian influence for a given value of sigma.
+
+        If cached is False, the profiles are calculated without the cache,
+        which is useful if sigma is never the same twice.
+        """
+        return SeparableInfluence(self, sigma, dtype, cached)
+
+    def truncated_influence(self,
+                            sigma,
+                            truncate,
+                            dtype=np.float64,
+                            max_fraction=0.02):
+        """
+        Get the gaussian influence, cut off at truncate * sigma.
+
+        An update through the stencil costs a lot more per neuron than an
+        update through the full influence, so if the stencil covers more
+        than max_fraction of the neurons, the full influence is returned
+        instead. On maps of 50x50 to 300x300 neurons, the stencil was only
+        faster when it covered less than 2.5 to 4% of the neurons.
+        """
+        largest = sum((width - 1) ** 2 for width in self.map_dimensions)
+        if (truncate * sigma) ** 2 >= largest:
+            return SeparableInfluence(self, sigma, dtype)
+
+        truncated = TruncatedInfluence(self, sigma, truncate, dtype)
+        if len(truncated.offsets) > max_fraction * self.num_neurons:
+            return SeparableInfluence(self, sigma, dtype)
+
+        return truncated
+
+
+class SeparableInfluence(object):
+    """
+    A gaussian neighborhood which is computed on demand.
+
+    The gaussian of a sum of squared distances is the product of the
+    gaussians of each term. The influence of a BMU on the map is therefore
+    the outer product of one row per axis of the map. Each row is a slice
+    of the profile of its axis, see gaussian_profile, so only a profile of
+    2 * width - 1 values is stored per axis, and the rows for a batch of
+    BMUs are gathered when they are needed.
+
+    Parameters
+    ----------
+    grid : Grid
+        The grid of the map.
+    sigma : float
+        The width of the gaussian.
+    dtype : numpy dtype, optional, default np.float64
+        The floating point type of the influence.
+    cached : bool, optional, default True
+        Whether to take the profiles from the cache of gaussian_profile.
+
+    """
+
+    def __init__(self, grid, sigma, dtype=np.float64, cached=True):
+        """Calculate the profile of each axis."""
+        self.grid = grid
+        profile = gaussian_profile if cached else gaussian_profile.__wrapped__
+        self.profiles = [profile(width, float(sigma), np.dtype(dtype))
+                         for width in grid.map_dimensions]
+        self.scale = 1.0
+
+    def __mul__(self, other):
+        """Scale the influence, e.g. by the learning rate."""
+        scaled = object.__new__(SeparableInfluence)
+        scaled.__dict__.update(self.__dict__)
+        scaled.scale = self.scale * float(other)
+        return scaled
+
+    __rmul__ = __mul__
+
+    def __getitem__(self, bmu):
+        """
+        Get the influence of a batch of BMUs on all neurons.
+
+        Parameters
+        ----------
+        bmu : numpy array
+            The index of the BMU for each item in the batch.
+
+        Returns
+        -------
+        influence : numpy array
+            The influence of each BMU on each neuron,
+            dim (len(bmu), num_neurons).
+
+        """
+        bmu = np.asarray(bmu)
+        coords = self.grid.coordinates[bmu.ravel()]
+        rows = [profile_rows(p) for p in self.profiles]
+
+        influence = rows[0][coords[:, 0]] * self.scale
+        for idx, axis in enumerate(rows[1:], 1):
+            influence = influence[:, :, None] * axis[coords[:, idx]][:, None]
+            influence = influence.reshape(len(coords), -1)
+
+        return influence.reshape(bmu.shape + (self.grid.num_neurons,))
+
+    def smooth(self, values, block_size=2**20):
+        """
+        Multiply some values on the map with the influence matrix.
+
+        This is equivalent to influence.dot(values), where influence is the
+        full num_neurons * num_neurons matrix, but is calculated by
+        multiplying the values with the influence along each axis in turn.
+        The rows of the influence along an axis are gathered in blocks, so
+        that the width * width table of an axis is never allocated.
+
+        Parameters
+        ----------
+        values : numpy array
+            The values of each neuron, dim (num_neurons, ...).
+        block_size : int, optional, default 1048576
+            The maximum number of influence values to gather at once.
+
+        Returns
+        -------
+        smoothed : numpy array
+            The smoothed values, with the same shape as values.
+
+        """
+        smoothed = values.reshape(self.grid.map_dimensions + values.shape[1:])
+        for axis, profile in enumerate(self.profiles):
+            rows = profile_rows(profile)
+            width = len(rows)
+            step = max(1, block_size // width)
+            result = np.empty(smoothed.shape,
+                              dtype=np.result_type(profile, smoothed))
+            for start in range(0, width, step):
+                block = np.ascontiguousarray(rows[start:start+step])
+                part = np.tensordot(block, smoothed, axes=([1], [axis]))
+                index = [slice(None)] * smoothed.ndim
+                index[axis] = slice(start, start+step)
+                result[tuple(index)] = np.moveaxis(part, 0, axis)
+            smoothed = result
+
+        return smoothed.reshape(values.shape) * self.scale
+
+
+class TruncatedInfluence(object):
+    """
+    A gaussian neighborhood which is truncated at a multiple of sigma.
+
+    Instead of storing the influence of each neuron on each other neuron,
+    this only stores a stencil: the offsets on the grid which lie within
+    truncate * sigma of a neuron, together with their influence. Indexing
+    this object with an array of BMUs returns the influence of each BMU
+    on its neighbors as a SparseInfluence, so that the cost of an update
+    depends on the size of the neighborhood, not on the size of the map.
+
+    Parameters
+    ----------
+    grid : Grid
+        The grid of the map.
+    sigma : float
+        The width of the gaussian.
+    truncate : float
+        The number of sigmas after which the neighborhood is cut off.
+    dtype : numpy dtype, optional, default np.float64
+        The floating point type of the influence.
+
+    """
+
+    def __init__(self, grid, sigma, truncate, dtype=np.float64):
+        """Create the stencil."""
+        self.grid = grid
+        self.offsets, self.values = gaussian_stencil(grid.map_dimensions,
+                                                     float(sigma),
+                                                     float(truncate),
+                                                     np.dtype(dtype))
+
+    def __mul__(self, other):
+        """Scale the influence, e.g. by the learning rate."""
+        scaled = object.__new__(TruncatedInfluence)
+        scaled.__dict__.update(self.__dict__)
+        scaled.values = self.values * float(other)
+        return scaled
+
+    __rmul__ = __mul__
+
+    def __getitem__(self, bmu):
+        """
+        Get the sparse influence of a batch of BMUs.
+
+        Parameters
+        ----------
+        bmu : numpy array
+            The index of the BMU for each item in the batch.
+
+        Returns
+        -------
+        influence : SparseInfluence
+            The batch item, the neuron and the influence of each
+            (batch item, neuron) pair inside the neighborhood.
+
+        """
+        coordinates = self.grid.coordinates[bmu]
+        coords = coordinates[:, None, :] + self.offsets[None, :, :]
+        dims = self.grid.map_dimensions
+        valid = np.all((coords >= 0) & (coords < dims), -1)
+        rows, cols = np.nonzero(valid)
+        neurons = np.ravel_multi_index(coords[rows, cols].T, dims)
+
+        return SparseInfluence(rows, neurons, self.values[cols])
+
+    def smooth(self, values):
+        """
+        Multiply some values on the map with the influence matrix.
+
+        Only the neighborhoods of neurons with non-zero values are visited.
+
+        Parameters
+        ----------
+        values : numpy array
+            The values of each neuron, dim (num_neurons, ...).
+
+        Returns
+        -------
+        smoothed : numpy array
+            The smoothed values, with the same shape as values.
+
+        """
+        flat = values.reshape(len(values), -1)
+        source = np.flatnonzero(flat.any(1))
+        rows, neurons, influence = self[source]
+
+        smoothed = np.zeros_like(flat)
+        scatter_add(smoothed,
+                    neurons,
+                    lambda b: flat[source[rows[b]]] * influence[b, None])
+
+        return smoothed.reshape(values.shape)
@@ -0,0 +1,206 @@
+"""An approximate nearest neighbor index over the weights of a map."""
+import numpy as np
+
+from .utilities import scatter_add, take_along_rows
+from ..distance import euclidean_distance, squared_norm
+
+
+def _smallest(distances, neurons, k):
+    """Select the k smallest distances in each row, in sorted order."""
+    if distances.shape[1] > k:
+        part = np.argpartition(distances, k-1, 1)[:, :k]
+        distances = take_along_rows(distances, part)
+        neurons = take_along_rows(neurons, part)
+    order = np.argsort(distances, 1)
+    return (take_along_rows(distances, order),
+            take_along_rows(neurons, order))
+
+
+class InvertedIndex(object):
+    """
+    An inverted file index over a set of weights.
+
+    The weights are clustered into a number of lists with k-means. To find
+    the nearest neurons of a data point, only the lists whose centroids are
+    closest to the data point are searched. This makes each query cost
+    roughly O(n_lists + n_probe * num_neurons / n_lists) instead of
+    O(num_neurons).
+
+    The index is exact for neurons in the probed lists, but a nearest neuron
+    can be missed if it lies in a list which was not probed. Raising n_probe
+    raises the recall, and setting it to n_lists gives exact results. If the
+    probed lists hold fewer than k neurons, the next closest lists are
+    searched as well, so that every query finds k neurons.
+
+    Lists which are left empty by k-means, e.g. because neurons have the
+    same weights, are removed, so there can be fewer than n_lists lists.
+
+    Parameters
+    ----------
+    weights : numpy array
+        The weights to index, dim (num_neurons * data_dimensionality).
+    n_lists : int, optional, default None
+        The number of lists. If this is None, the square root of the number
+        of neurons is used.
+    n_probe : int, optional, default 1
+        The number of lists to search for each query.
+    num_iterations : int, optional, default 10
+        The number of k-means iterations used to cluster the weights.
+    batch_size : int, optional, default 1024
+        The number of data points to query at the same time.
+    metric : numpy array, optional, default None
+        A weight for each feature, dim (data_dimensionality,). If this is
+        not None, the weighted euclidean distance is used for clustering and
+        querying, see InferenceForm.
+
+    Attributes
+    ----------
+    centroids : numpy array
+        The centroid of each list, dim (n_lists * data_dimensionality).
+    lists : list of numpy arrays
+        The indices of the neurons in each list.
+
+    """
+
+    def __init__(self,
+                 weights,
+                 n_lists=None,
+                 n_probe=1,
+                 num_iterations=10,
+                 batch_size=1024,
+                 metric=None):
+        """Cluster the weights into lists."""
+        num_neurons = len(weights)
+        if n_lists is None:
+            n_lists = int(np.ceil(np.sqrt(num_neurons)))
+        if not 0 < n_lists <= num_neurons:
+            raise ValueError("n_lists should be between 1 and the number "
+                             "of neurons, is {0}".format(n_lists))
+
+        self.weights = weights
+        self.metric = metric
+        self.norm = squared_norm(weights, metric)
+        self.n_probe = n_probe
+        self.batch_size = batch_size
+
+        seeds = np.random.choice(num_neurons, n_lists, replace=False)
+        centroids = weights[seeds].astype(np.float64)
+        for _ in range(num_iterations):
+            assignment = self._distance(weights, centroids).argmin(1)
+            counts = np.bincount(assignment, minlength=n_lists)
+            sums = np.zeros_like(centroids)
+            scatter_add(sums, assignment, weights)
+            # Empty lists keep their old centroid.
+            full = counts > 0
+            centroids[full] = sums[full] / counts[full, None]
+
+        # Remove the lists which are still empty, so that probing a list
+        # always yields at least one neuron.
+        assignment = self._distance(weights, centroids).argmin(1)
+        counts = np.bincount(assignment, minlength=n_lists)
+        full = np.flatnonzero(counts)
+        centroids = centroids[full]
+        assignment = np.searchsorted(full, assignment)
+
+        self.centroids = centroids.astype(weights.dtype)
+        order = np.argsort(assignment, kind='mergesort')
+        self.lists = np.split(order, np.cumsum(counts[full])[:-1])
+
+    def _distance(self, X, nodes, nodes_norm=None):
+        """Calculate the distance between data and nodes, see metric."""
+        if self.metric is None:
+            return euclidean_distance(X, nodes, nodes_norm)
+        if nodes_norm is None:
+            nodes_norm = squared_norm(nodes, self.metric)
+        return euclidean_distance(X,
+                                  nodes * self.metric,
+                                  nodes_norm,
+                                  squared_norm(X, self.metric))
+
+    @property
+    def n_lists(self):
+        """The number of lists."""
+        return len(self.lists)
+
+    def query(self, X, k=1):
+        """
+        Find the k nearest neurons of each data point.
+
+        Parameters
+        ----------
+        X : numpy array
+            The data, dim (M * data_dimensionality).
+        k : int, optional, default 1
+            The number of neurons to return.
+
+        Returns
+        -------
+        distances : numpy array
+            The euclidean distance to each of the k nearest neurons, sorted
+            in ascending order, dim (M * k). If k is larger than the number
+            of neurons, the remaining distances are inf.
+        neurons : numpy array
+            The index of each of the k nearest neurons, dim (M * k). If k is
+            larger than the number of neurons, the remaining indices are -1.
+
+        """
+        distances = np.empty((len(X), k), dtype=self.weights.dtype)
+        neurons = np.empty((len(X), k), dtype=np.int64)
+        for start in range(0, len(X), self.batch_size):
+            batch = slice(start, start + self.batch_size)
+            distances[batch], neurons[batch] = self._query(X[batch], k)
+
+        return distances, neurons
+
+    def _query(self, X, k):
+        """Query a single batch."""
+        n_probe = min(self.n_probe, self.n_lists)
+        coarse = self._distance(X, self.centroids)
+        if n_probe < self.n_lists:
+            probe = np.argpartition(coarse, n_probe-1, 1)[:, :n_probe]
+        else:
+            probe = np.broadcast_to(np.arange(self.n_lists), coarse.shape)
+
+        best = np.full((len(X), k), np.inf, dtype=self.weights.dtype)
+        best_neurons = np.full((len(X), k), -1, dtype=np.int64)
+        self._search(X, np.arange(len(X)), probe, best, best_neurons, k)
+
+        # Data points whose probed lists hold fewer than k neurons search
+        # again from scratch, one list at a time, closest list first.
+        last = min(k, len(self.weights)) - 1
+        short = np.flatnonzero(best_neurons[:, last] < 0)
+        if len(short):
+            best[short] = np.inf
+            best_neurons[short] = -1
+            ranked = np.argsort(coarse[short], 1)
+            for column in range(self.n_lists):
+                missing = best_neurons[short, last] < 0
+                if not missing.any():
+                    break
+                self._search(X,
+                             short[missing],
+                             ranked[missing, column:column+1],
+                             best,
+                             best_neurons,
+                             k)
+
+        return best, best_neurons
+
+    def _search(self, X, rows, probe, best, best_neurons, k):
+        """Search the lists in probe for the rows of X, in place."""
+        # Visit each probed list once, with all data points which probe it.
+        rows = np.repeat(rows, probe.shape[1])
+        probe = probe.ravel()
+        order = np.argsort(probe, kind='mergesort')
+        probed, first = np.unique(probe[order], return_index=True)
+
+        for idx, rows in zip(probed, np.split(rows[order], first[1:])):
+            members = self.lists[idx]
+            dist = self._distance(X[rows],
+                                  self.weights[members],
+                                  self.norm[members])
+            candidates = np.broadcast_to(members, dist.shape)
+            best[rows], best_neurons[rows] = _smallest(
+                np.concatenate([best[rows], dist], 1),
+                np.concatenate([best_neurons[rows], candidates], 1),
+                k)
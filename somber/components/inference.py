@@ -0,0 +1,67 @@
+"""The weights of a trained map, prepared for inference."""
+from ..distance import euclidean_distance, squared_norm
+
+
+class InferenceForm(object):
+    """
+    Calculates the distances to a set of weights in the space of a scaler.
+
+    A learner with a scaler is trained on scaled data, but its weights are
+    stored in the space of the data. Instead of scaling each batch of data,
+    the distance in the scaled space is calculated directly on the data,
+    as a euclidean distance in which the squared difference of each feature
+    is multiplied by a weight, see Scaler.metric. The weights are
+    multiplied by this metric, and their norms are calculated, once, so
+    the distance to a batch costs a single matrix product, and no copy of
+    the batch is made.
+
+    Parameters
+    ----------
+    weights : numpy array
+        The weights in the space of the data, dim (num_neurons * dim).
+    scaler : Scaler, optional, default None
+        The scaler which was used to train the weights. If this is None,
+        or if the scaler has not been fit, the plain euclidean distance is
+        calculated.
+
+    Attributes
+    ----------
+    metric : numpy array or None
+        The weight of each feature, dim (dim,).
+    projected : numpy array
+        The weights multiplied by the metric, dim (num_neurons * dim).
+    norm : numpy array
+        The squared weighted norm of each neuron, dim (num_neurons,).
+
+    """
+
+    def __init__(self, weights, scaler=None):
+        """Precompute the weighted weights and their norms."""
+        self.weights = weights
+        self.metric = None
+        self.projected = weights
+        if scaler is not None and scaler.is_fit:
+            self.metric = scaler.metric().astype(weights.dtype)
+            self.projected = weights * self.metric
+        self.norm = squared_norm(weights, self.metric)
+
+    def distance(self, x):
+        """
+        Calculate the distance between a batch of data and the weights.
+
+        Parameters
+        ----------
+        x : numpy array
+            The data, in the space of the weights, dim (batch_size * dim).
+
+        Returns
+        -------
+        distances : numpy array
+            The distance from each data point to each neuron in the scaled
+            space, dim (batch_size * num_neurons).
+
+        """
+        return euclidean_distance(x,
+                                  self.projected,
+                                  self.norm,
+                                  squared_norm(x, self.metric))
@@ -0,0 +1,161 @@
+"""Counting the receptive fields of sequential maps."""
+import numpy as np
+
+
+# The multiplier of the neuron in a (neuron, symbol) key, which leaves room
+# for all symbols, including those which have not been seen yet.
+KEY_BASE = 2 ** 31
+
+
+class ReceptiveField(object):
+    """
+    Counts the symbols which precede the activation of each neuron.
+
+    The symbols are encoded as integers, and for each lag up to max_len,
+    the number of times each (neuron, symbol) pair occurs is counted with
+    a single grouped count over all data points. The counts can be updated
+    chunk by chunk, so that the receptive field of a corpus which does not
+    fit in memory can be calculated. The lags of the first items of a chunk
+    are taken from the end of the previous chunk.
+
+    Parameters
+    ----------
+    max_len : int, optional, default 10
+        The maximum length of a receptive field.
+
+    Attributes
+    ----------
+    symbols : list
+        The symbol of each integer id.
+    total : numpy array
+        The number of times each neuron was the BMU.
+
+    """
+
+    def __init__(self, max_len=10):
+        """Initialize the counts."""
+        self.max_len = max_len
+        self.symbols = []
+        self._ids = {}
+        self.total = np.zeros(0, dtype=np.int64)
+        # The (neuron, symbol) keys and their counts for each lag.
+        self._keys = [np.zeros(0, dtype=np.int64) for _ in range(max_len)]
+        self._counts = [np.zeros(0, dtype=np.int64) for _ in range(max_len)]
+        # The ids of the last items seen, which precede the next chunk.
+        self._history = np.zeros(0, dtype=np.int64)
+
+    def _encode(self, identities):
+        """Convert symbols to integer ids, adding new symbols."""
+        ids = self._ids
+        encoded = [ids.setdefault(x, len(ids)) for x in identities]
+        if len(ids) > len(self.symbols):
+            self.symbols.extend(list(ids)[len(self.symbols):])
+        return np.asarray(encoded, dtype=np.int64)
+
+    def update(self, predictions, identities):
+        """
+        Add the counts of a chunk of data.
+
+        Parameters
+        ----------
+        predictions : numpy array
+            The BMU of each data point in the chunk.
+        identities : list
+            The symbol of each data point in the chunk.
+
+        Returns
+        -------
+        self : ReceptiveField
+            The receptive field itself.
+
+        """
+        predictions = np.asarray(predictions, dtype=np.int64)
+        if len(predictions) != len(identities):
+            raise ValueError("X and identities are not the same length: "
+                             "{0} and {1}".format(len(predictions),
+                                                  len(identities)))
+
+        counts = np.bincount(predictions, minlength=len(self.total))
+        self.total = np.pad(self.total,
+                            (0, len(counts) - len(self.total)),
+                            mode='constant')
+        self.total += counts
+
+        # Prepend the history, so that each lag can be read from a slice.
+        ids = np.concatenate([self._history, self._encode(identities)])
+        offset = len(self._history)
+
+        for lag in range(self.max_len):
+            # If the history and the chunk together are not longer than the
+            # lag, no data point has a symbol at this lag or any larger one.
+            if len(ids) <= lag or not len(predictions):
+                break
+            start = offset - lag
+            # The first data points have no symbol at this lag.
+            valid = slice(max(0, -start), None)
+            lagged = ids[max(start, 0):len(ids) - lag]
+            keys = predictions[valid] * KEY_BASE + lagged
+            self._merge(lag, keys)
+
+        self._history = ids[max(0, len(ids) - self.max_len + 1):]
+        return self
+
+    def _merge(self, lag, keys):
+        """Add the counts of some keys to the counts of a lag."""
+        keys, counts = np.unique(keys, return_counts=True)
+        keys = np.concatenate([self._keys[lag], keys])
+        counts = np.concatenate([self._counts[lag], counts])
+        self._keys[lag], inverse = np.unique(keys, return_inverse=True)
+        self._counts[lag] = np.bincount(inverse, counts).astype(np.int64)
+
+    def fields(self, threshold=0.9):
+        """
+        Get the receptive field of each neuron.
+
+        At each lag, starting at the current data point, the most common
+        symbol of each neuron is added to its receptive field if its
+        proportion of all activations of the neuron is higher than
+        threshold. The receptive field ends at the first lag for which this
+        is not the case. Neurons which were the BMU of only a single data
+        point are left out, because nothing can be said about them.
+
+        Parameters
+        ----------
+        threshold : float, optional, default .9
+            The proportion of the activations which should share a symbol.
+
+        Returns
+        -------
+        receptive_fields : dict
+            A dictionary mapping from the neuron id to the found sequence
+            for that neuron, starting at the most recent symbol.
+
+        """
+        neurons = np.flatnonzero(self.total > 1)
+        alive = np.ones(len(neurons), dtype=bool)
+        found = []
+
+        for lag in range(self.max_len):
+            keys, counts = self._keys[lag], self._counts[lag]
+            owner = keys // KEY_BASE
+            # Sort by neuron, then by decreasing count, and take the first
+            # key of each neuron.
+            order = np.lexsort((-counts, owner))
+            owner, first = np.unique(owner[order], return_index=True)
+            best = order[first]
+
+            symbol = np.full(len(self.total), -1, dtype=np.int64)
+            count = np.zeros(len(self.total), dtype=np.int64)
+            symbol[owner] = keys[best] % KEY_BASE
+            count[owner] = counts[best]
+
+            alive &= count[neurons] / self.total[neurons] > threshold
+            if not alive.any():
+                break
+            found.append(np.where(alive, symbol[neurons], -1))
+
+        rec = {}
+        for idx, neuron in enumerate(neurons.tolist()):
+            rec[neuron] = [self.symbols[x[idx]] for x in found if x[idx] >= 0]
+
+        return rec
@@ -0,0 +1,118 @@
+"""Reading and writing models to disk."""
+import json
+import struct
+import numpy as np
+
+
+# The magic string which starts each binary model file.
+MAGIC = b"\x93SOMBER\x01"
+# Arrays are aligned to this many bytes in the file.
+ALIGNMENT = 64
+
+
+def _aligned(offset):
+    """Round an offset up to the next multiple of ALIGNMENT."""
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _to_json(obj):
+    """Convert numpy scalars and dtypes for json.dump."""
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.dtype):
+        return obj.name
+    raise TypeError("{0} is not JSON serializable".format(type(obj)))
+
+
+def save_model(path, header, arrays):
+    """
+    Save a model to a binary file.
+
+    The file consists of a short magic string, the length of the header,
+    a JSON header, and the raw contents of each array. The header contains
+    the dtype, shape and position of each array, and each array starts at
+    a multiple of 64 bytes, so that it can be memory-mapped.
+
+    Parameters
+    ----------
+    path : str
+        The path to save to.
+    header : dict
+        A JSON serializable dictionary with the parameters of the model.
+    arrays : dict
+        A dictionary mapping from names to numpy arrays.
+
+    """
+    header = dict(header)
+    arrays = {k: np.ascontiguousarray(v) for k, v in arrays.items()}
+
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = {'dtype': array.dtype.str,
+                        'shape': list(array.shape),
+                        'offset': offset}
+        offset = _aligned(offset + array.nbytes)
+    header['arrays'] = layout
+
+    encoded = json.dumps(header, default=_to_json).encode('utf-8')
+    start = _aligned(len(MAGIC) + 8 + len(encoded))
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(encoded)))
+        f.write(encoded)
+        for name, array in arrays.items():
+            f.seek(start + layout[name]['offset'])
+            f.write(array.data)
+
+
+def load_model(path, mmap=False):
+    """
+    Load a model saved with save_model.
+
+    Models which were saved as JSON by older versions of this package
+    are also supported. In that case, the arrays are returned as lists.
+
+    Parameters
+    ----------
+    path : str
+        The path to the file.
+    mmap : bool, optional, default False
+        If this is True, the arrays are memory-mapped from the file instead
+        of being read into memory. The arrays are mapped copy-on-write: the
+        pages of the file are shared between all processes which load it,
+        while changes to the arrays are private and never written back.
+
+    Returns
+    -------
+    data : dict
+        The header of the model, with each array added under its name.
+
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            f.seek(0)
+            return json.loads(f.read().decode('utf-8'))
+
+        length, = struct.unpack('<Q', f.read(8))
+        data = json.loads(f.read(length).decode('utf-8'))
+        start = _aligned(len(MAGIC) + 8 + length)
+
+        for name, info in data.pop('arrays').items():
+            dtype = np.dtype(info['dtype'])
+            shape = tuple(info['shape'])
+            count = int(np.prod(shape))
+            if mmap and count:
+                array = np.memmap(path,
+                                  dtype=dtype,
+                                  mode='c',
+                                  offset=start + info['offset'],
+                                  shape=shape)
+            else:
+                f.seek(start + info['offset'])
+                array = np.fromfile(f, dtype=dtype, count=count)
+                array = array.reshape(shape)
+            data[name] = array
+
+    return data
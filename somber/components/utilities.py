@@ -1,6 +1,12 @@
 """Utility functions."""
+import functools
+import hashlib
+import threading
 import numpy as np
 
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 
 class Scaler(object):
     """
@@ -14,6 +20,8 @@ class Scaler(object):
         The columnwise standard deviation of the data after scaling.
     is_fit : bool
         Indicates whether this scaler has been fit yet.
+    count : int
+        The number of data points the scaler has been fit on.
 
     """
 
@@ -22,48 +30,657 @@ class Scaler(object):
         self.mean = None
         self.std = None
         self.is_fit = False
+        self.count = 0
 
     def fit_transform(self, X):
         """First call fit, then call transform."""
         self.fit(X)
         return self.transform(X)
 
-    def fit(self, X):
+    def fit(self, X, block_size=2**16):
         """
         Fit the scaler based on some data.
 
         Takes the columnwise mean and standard deviation of the entire input
         array.
         If the array has more than 2 dimensions, it is flattened.
+        The array is processed in blocks of rows, which are merged with
+        partial_fit, so that only one block is copied at a time.
 
         Parameters
         ----------
         X : numpy array
+        block_size : int, optional, default 65536
+            The number of rows to process at the same time.
 
         Returns
         -------
-        scaled : numpy array
-            A scaled version of said array.
+        self : Scaler
+            The scaler itself.
 
         """
         if X.ndim > 2:
             X = X.reshape((np.prod(X.shape[:-1]), X.shape[-1]))
-        self.mean = X.mean(0)
-        self.std = X.std(0)
-        self.is_fit = True
+        self.mean = None
+        self.std = None
+        self.count = 0
+        self.is_fit = False
+        for start in range(0, X.shape[0], block_size):
+            self.partial_fit(X[start:start+block_size])
         return self
 
-    def transform(self, X):
-        """Transform your data to zero mean unit variance."""
+    def partial_fit(self, X):
+        """
+        Update the scaler with a chunk of data.
+
+        The mean and variance of the chunk are merged with the current
+        mean and variance, see merge. Fitting on all chunks of a dataset
+        gives the same result as fitting on the dataset as a whole.
+
+        Parameters
+        ----------
+        X : numpy array
+            A chunk of data.
+
+        Returns
+        -------
+        self : Scaler
+            The scaler itself.
+
+        """
+        if X.ndim > 2:
+            X = X.reshape((np.prod(X.shape[:-1]), X.shape[-1]))
+        if not X.shape[0]:
+            return self
+
+        chunk = Scaler()
+        chunk.mean = X.mean(0)
+        chunk.std = X.std(0)
+        chunk.count = X.shape[0]
+        chunk.is_fit = True
+        return self.merge(chunk)
+
+    def merge(self, other):
+        """
+        Merge the statistics of another scaler into this scaler.
+
+        The means and variances are combined with the pairwise update of
+        Chan et al., which is numerically stable. This can be used to fit
+        scalers on parts of a dataset in parallel, and combine them
+        afterwards.
+
+        Parameters
+        ----------
+        other : Scaler
+            A scaler which was fit on other data.
+
+        Returns
+        -------
+        self : Scaler
+            The scaler itself, with the statistics of both scalers.
+
+        """
+        if not other.is_fit:
+            return self
+        if not self.is_fit:
+            self.mean = np.array(other.mean, copy=True)
+            self.std = np.array(other.std, copy=True)
+            self.count = other.count
+            self.is_fit = True
+            return self
+
+        total = self.count + other.count
+        delta = other.mean - self.mean
+        sq_diff = (self.std ** 2) * self.count
+        sq_diff += (other.std ** 2) * other.count
+        sq_diff += (delta ** 2) * (self.count * other.count / total)
+
+        self.mean = self.mean + delta * (other.count / total)
+        self.std = np.sqrt(sq_diff / total)
+        self.count = total
+        return self
+
+    def transform(self, X, out=None):
+        """
+        Transform your data to zero mean unit variance.
+
+        Parameters
+        ----------
+        X : numpy array
+            The data to transform.
+        out : numpy array, optional, default None
+            The array to write the result to, which can be X itself. If this
+            is None, a new array is allocated.
+
+        Returns
+        -------
+        transformed : numpy array
+            The transformed data.
+
+        """
+        if not self.is_fit:
+            raise ValueError("The scaler has not been fit yet.")
+        out = np.subtract(X, self.mean, out=out)
+        out /= (self.std + 10e-7)
+        return out
+
+    def metric(self):
+        """
+        Get the weight of each feature in distances between scaled data.
+
+        The squared euclidean distance between two transformed data points
+        is equal to the sum of the squared differences of the untransformed
+        data points, each multiplied by the weight of its feature. The mean
+        cancels out, so the distance can be calculated without
+        transforming the data.
+
+        Returns
+        -------
+        metric : numpy array
+            The weight of each feature.
+
+        """
         if not self.is_fit:
             raise ValueError("The scaler has not been fit yet.")
-        return (X-self.mean) / (self.std + 10e-7)
+        return 1 / (self.std + 10e-7) ** 2
+
+    def inverse_transform(self, X, out=None):
+        """
+        Invert the transformation.
+
+        Parameters
+        ----------
+        X : numpy array
+            The data to transform back.
+        out : numpy array, optional, default None
+            The array to write the result to, which can be X itself. If this
+            is None, a new array is allocated.
+
+        Returns
+        -------
+        transformed : numpy array
+            The data in the original space.
+
+        """
+        out = np.multiply(X, self.std, out=out)
+        out += self.mean
+        return out
+
+
+def scatter_add(out, indices, values, block_size=2**16):
+    """
+    Add rows of values to the rows of out given by indices.
+
+    This is equivalent to np.add.at(out, indices, values), but is a lot
+    faster, because it sorts the values by their index and sums them with
+    np.add.reduceat. The values are processed in blocks, and can be given as
+    a function of the block, so that the values never need to be
+    materialized all at once.
+
+    Parameters
+    ----------
+    out : numpy array
+        The array to add to, dim (M * N).
+    indices : numpy array
+        The row of out to add each value to, dim (P,).
+    values : numpy array or function
+        The values to add, dim (P * N). If this is a function, it is called
+        with a slice of the indices, and should return the corresponding
+        values.
+    block_size : int, optional, default 65536
+        The number of values to sum at the same time.
+
+    Returns
+    -------
+    out : numpy array
+        The same array as out.
+
+    """
+    for start in range(0, len(indices), block_size):
+        block = slice(start, start + block_size)
+        if callable(values):
+            v = values(block)
+        else:
+            v = values[block]
+        idx = indices[block]
+        order = np.argsort(idx, kind='mergesort')
+        unique, first = np.unique(idx[order], return_index=True)
+        out[unique] += np.add.reduceat(v[order], first, axis=0)
+
+    return out
+
+
+def take_along_rows(values, indices):
+    """
+    Select values[i, indices[i, j]] from each row i of a 2D array.
+
+    This is np.take_along_axis(values, indices, 1), which needs numpy 1.15.
+    """
+    return values[np.arange(len(values))[:, None], indices]
+
+
+def put_along_rows(out, indices, values):
+    """
+    Set out[i, indices[i, j]] to values[i, j] in each row i of a 2D array.
+
+    This is np.put_along_axis(out, indices, values, 1), which needs numpy
+    1.15.
+    """
+    out[np.arange(len(out))[:, None], indices] = values
+    return out
+
+
+def top_k(values, k, largest=False):
+    """
+    Get the indices of the k smallest or largest values in each row.
+
+    This uses a partial selection, followed by a sort of only the k selected
+    values, which is O(N + k log k) per row instead of O(N log N).
+
+    Parameters
+    ----------
+    values : numpy array
+        The values, dim (M * N).
+    k : int
+        The number of values to select from each row.
+    largest : bool, optional, default False
+        Whether to select the largest instead of the smallest values.
+
+    Returns
+    -------
+    indices : numpy array
+        The column index of each selected value, sorted from best to worst,
+        dim (M * k).
+    selected : numpy array
+        The selected values, dim (M * k).
+
+    """
+    k = min(k, values.shape[1])
+    keys = -values if largest else values
+    if k < values.shape[1]:
+        indices = np.argpartition(keys, k-1, 1)[:, :k]
+    else:
+        indices = np.broadcast_to(np.arange(k), keys.shape)
+    order = np.argsort(take_along_rows(keys, indices), 1)
+    indices = take_along_rows(indices, order)
+    return indices, take_along_rows(values, indices)
 
-    def inverse_transform(self, X):
-        """Invert the transformation."""
-        return ((X * self.std) + self.mean)
 
+def fingerprint(*arrays):
+    """
+    Calculate a hash of the contents, shapes and types of some arrays.
+
+    Parameters
+    ----------
+    arrays : numpy arrays
+        The arrays to hash.
+
+    Returns
+    -------
+    fingerprint : str
+        A hexadecimal digest which only changes if one of the arrays
+        changes.
+
+    """
+    digest = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(str((array.dtype.str, array.shape)).encode('utf-8'))
+        digest.update(array.reshape(-1).view(np.uint8))
+    return digest.hexdigest()
+
+
+def array_cache(max_bytes=2**25):
+    """
+    Cache the arrays returned by a function, up to a total size in bytes.
+
+    This works like functools.lru_cache, but the size of the cache is the
+    number of bytes of the cached arrays, not the number of results, so
+    that a cache of arrays which grow with the size of a map can not grow
+    without bound. The least recently used results are dropped first, and
+    results which are larger than max_bytes are not cached at all.
+
+    This is used for the influence tables of the learners, which only
+    depend on the geometry of the map, the schedule and the dtype, so that
+    fitting with the same geometry and schedule again, e.g. in a sweep,
+    does not calculate them again. The cached arrays are shared, so the
+    function should make them read-only.
+
+    Parameters
+    ----------
+    max_bytes : int, optional, default 33554432
+        The maximum number of bytes in the cache.
+
+    Returns
+    -------
+    decorator : callable
+        A decorator for a function which returns a numpy array or a tuple
+        of numpy arrays, and whose arguments are hashable. The decorated
+        function has a cache_clear method.
+
+    """
+    def nbytes(result):
+        if isinstance(result, tuple):
+            return sum(x.nbytes for x in result)
+        return result.nbytes
+
+    def decorator(function):
+        cache = OrderedDict()
+        lock = threading.Lock()
+        # The total number of bytes in the cache.
+        size = [0]
+
+        @functools.wraps(function)
+        def wrapper(*args):
+            with lock:
+                if args in cache:
+                    cache.move_to_end(args)
+                    return cache[args]
+
+            result = function(*args)
+            result_size = nbytes(result)
+            if result_size > max_bytes:
+                return result
+
+            with lock:
+                if args not in cache:
+                    cache[args] = result
+                    size[0] += result_size
+                while size[0] > max_bytes:
+                    _, dropped = cache.popitem(last=False)
+                    size[0] -= nbytes(dropped)
+            return result
+
+        def cache_clear():
+            with lock:
+                cache.clear()
+                size[0] = 0
+
+        wrapper.cache_clear = cache_clear
+        return wrapper
+
+    return decorator
+
+
+def ordered_map(function, iterable, n_jobs=1, window=None):
+    """
+    Apply a function to each item of an iterable in a thread pool.
+
+    The results are yielded in the order of the items. Unlike
+    ThreadPoolExecutor.map, which submits all items at once, at most window
+    items are submitted ahead of the result which is yielded, so that the
+    results of a long iterable do not pile up in memory.
+
+    Parameters
+    ----------
+    function : callable
+        The function to apply.
+    iterable : iterable
+        The items.
+    n_jobs : int, optional, default 1
+        The number of threads. If this is 1, the function is applied in the
+        calling thread.
+    window : int, optional, default None
+        The maximum number of items which are submitted but not yet
+        yielded. If this is None, 2 * n_jobs is used.
+
+    Yields
+    ------
+    result : object
+        The result of the function for each item.
+
+    """
+    if n_jobs == 1:
+        for item in iterable:
+            yield function(item)
+        return
+
+    window = window or 2 * n_jobs
+    with ThreadPoolExecutor(n_jobs) as pool:
+        pending = deque()
+        for item in iterable:
+            pending.append(pool.submit(function, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class Batches(object):
+    """
+    Iterates over an array in batches.
+
+    If the data is shuffled, a permutation of the indices is drawn, and the
+    rows of each batch are gathered into a single buffer which is reused for
+    every batch. Otherwise, each batch is a view of the array. In both cases
+    the data is never copied as a whole. All batches have batch_size rows,
+    except the last one, which is shorter if batch_size does not divide the
+    number of rows.
+
+    Because the buffer is reused, a batch is only valid until the next batch
+    is requested.
+
+    Parameters
+    ----------
+    X : numpy array
+        The data, dim (M * N).
+    batch_size : int
+        The number of rows in each batch.
+    shuffle_data : bool, optional, default True
+        Whether to visit the rows in a random order.
+
+    """
+
+    def __init__(self, X, batch_size, shuffle_data=True):
+        """Initialize the iterator."""
+        self.X = X
+        self.batch_size = max(1, min(batch_size, len(X)))
+        self.shuffle_data = shuffle_data
+
+    def __len__(self):
+        """The number of batches."""
+        return -(-len(self.X) // self.batch_size)
+
+    def __iter__(self):
+        """Iterate over the batches."""
+        if not self.shuffle_data:
+            for start in range(0, len(self.X), self.batch_size):
+                yield self.X[start:start+self.batch_size]
+            return
+
+        indices = np.random.permutation(len(self.X))
+        buffer = np.empty((self.batch_size,) + self.X.shape[1:],
+                          dtype=self.X.dtype)
+        for start in range(0, len(self.X), self.batch_size):
+            index = indices[start:start+self.batch_size]
+            batch = buffer[:len(index)]
+            np.take(self.X, index, axis=0, out=batch)
+            yield batch
+
+
+class Lanes(object):
+    """
+    Packs sequences into lanes which are processed in parallel.
+
+    Starting with the longest sequence, each sequence is assigned to the
+    lane which is shortest so far, which keeps the lanes close to equal
+    length. The sequences in a lane are processed one after the other.
+    Iterating over the lanes yields, for each time step, the row of the data
+    each lane processes, and whether that row starts a new sequence, in
+    which case the context of the lane should be reset. Lanes which have run
+    out of data have a row of -1, and should be masked out.
+
+    Parameters
+    ----------
+    lengths : list of int
+        The length of each sequence. The sequences are assumed to be stored
+        one after the other in a single array.
+    num_lanes : int
+        The maximum number of lanes.
+
+    Attributes
+    ----------
+    rows : numpy array
+        The row processed by each lane at each time step,
+        dim (num_steps * num_lanes).
+    reset : numpy array
+        Whether each lane starts a new sequence at each time step,
+        dim (num_steps * num_lanes).
+
+    """
+
+    def __init__(self, lengths, num_lanes):
+        """Assign the sequences to lanes."""
+        lengths = [int(x) for x in lengths if x > 0]
+        num_lanes = max(1, min(num_lanes, len(lengths)))
+        starts = np.cumsum([0] + lengths[:-1])
+
+        lanes = [[] for _ in range(num_lanes)]
+        totals = np.zeros(num_lanes, dtype=np.int64)
+        for idx in np.argsort(-np.asarray(lengths), kind='mergesort'):
+            start, length = starts[idx], lengths[idx]
+            lane = totals.argmin()
+            lanes[lane].append((start, length))
+            totals[lane] += length
+
+        self.rows = np.full((max(totals.max(), 0), num_lanes), -1,
+                            dtype=np.int64)
+        self.reset = np.zeros(self.rows.shape, dtype=bool)
+        for idx, lane in enumerate(lanes):
+            step = 0
+            for start, length in lane:
+                self.rows[step:step+length, idx] = np.arange(start,
+                                                             start+length)
+                self.reset[step, idx] = True
+                step += length
+
+    @property
+    def num_lanes(self):
+        """The number of lanes."""
+        return self.rows.shape[1]
+
+    def __len__(self):
+        """The number of time steps."""
+        return len(self.rows)
+
+    def __iter__(self):
+        """Iterate over the rows and resets of each time step."""
+        return zip(self.rows, self.reset)
+
+
+class ChunkReader(object):
+    """
+    Reads data which does not fit in memory in chunks.
+
+    Parameters
+    ----------
+    X : numpy array or iterable
+        The data. This can be a (memory-mapped) array, which is read in
+        blocks of chunk_size rows, or an iterable of 2D arrays. An iterable
+        needs to be iterated once per epoch, so it can not be a generator.
+    chunk_size : int, optional, default 100000
+        The number of rows to read at the same time from an array.
+    dtype : numpy dtype, optional, default np.float64
+        The type to convert each chunk to.
+
+    Attributes
+    ----------
+    transform : function
+        A function which is applied to each chunk after reading it,
+        e.g. the transform of a Scaler. Can be None.
+
+    """
+
+    def __init__(self, X, chunk_size=100000, dtype=np.float64):
+        """Initialize the reader."""
+        if not isinstance(X, np.ndarray) and iter(X) is X:
+            raise ValueError("Your data is an iterator, which can only be "
+                             "read once. Please pass a list of arrays, or "
+                             "another iterable which can be read again.")
+        self.X = X
+        self.chunk_size = chunk_size
+        self.dtype = dtype
+        self.transform = None
+        self._length = None
+
+    def __len__(self):
+        """The number of rows in the data."""
+        if self._length is None:
+            if isinstance(self.X, np.ndarray):
+                self._length = len(self.X)
+            else:
+                # A chunk with one dimension is a single row, see chunks.
+                self._length = sum(len(x) if np.ndim(x) > 1 else 1
+                                   for x in self.X)
+        return self._length
+
+    @property
+    def shape(self):
+        """The shape of the data as a whole."""
+        dim = np.shape(next(iter(self._raw_chunks())))[-1]
+        return len(self), dim
+
+    def _raw_chunks(self, shuffle_data=False):
+        """Iterate over the chunks as they are stored."""
+        if isinstance(self.X, np.ndarray):
+            starts = np.arange(0, len(self.X), self.chunk_size)
+            if shuffle_data:
+                starts = np.random.permutation(starts)
+            for start in starts:
+                yield self.X[start:start+self.chunk_size]
+        elif shuffle_data and hasattr(self.X, '__getitem__'):
+            for idx in np.random.permutation(len(self.X)):
+                yield self.X[idx]
+        else:
+            for chunk in self.X:
+                yield chunk
+
+    def chunks(self, shuffle_data=False):
+        """
+        Iterate over the chunks.
+
+        Each chunk is read into memory, converted to dtype and transformed.
+
+        Parameters
+        ----------
+        shuffle_data : bool, optional, default False
+            If this is True, the chunks are visited in a random order where
+            possible, and the rows in each chunk are shuffled.
+
+        """
+        for chunk in self._raw_chunks(shuffle_data):
+            chunk = np.asarray(chunk, dtype=self.dtype)
+            if chunk.ndim == 1:
+                chunk = chunk.reshape(1, -1)
+            if self.transform is not None:
+                chunk = self.transform(chunk)
+            if shuffle_data:
+                chunk = chunk[np.random.permutation(len(chunk))]
+            yield chunk
+
+    def batches(self, batch_size, shuffle_data=True):
+        """
+        Iterate over batches of the data.
+
+        All batches have batch_size rows, except the last one. Rows which
+        are left at the end of a chunk are carried over to the next chunk.
+
+        Parameters
+        ----------
+        batch_size : int
+            The number of rows in each batch.
+        shuffle_data : bool, optional, default True
+            Whether to shuffle the chunks, see chunks.
+
+        """
+        leftover = None
+        for chunk in self.chunks(shuffle_data):
+            if leftover is not None and len(leftover):
+                chunk = np.concatenate([leftover, chunk])
+            end = (len(chunk) // batch_size) * batch_size
+            for start in range(0, end, batch_size):
+                yield chunk[start:start+batch_size]
+            leftover = chunk[end:]
 
-def shuffle(array):
-    """Gpu/cpu-agnostic shuffle function."""
-    return np.random.permutation(array)
+        if leftover is not None and len(leftover):
+            yield leftover
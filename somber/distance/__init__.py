@@ -1,3 +1,4 @@
 from .distance import euclidean
+from .expanded import euclidean_distance, squared_norm
 
-__all__ = ["euclidean"]
+__all__ = ["euclidean", "euclidean_distance", "squared_norm"]
@@ -8,22 +8,26 @@ DTYPE_F = np.float64
 ctypedef np.int64_t DTYPE_t
 ctypedef np.float64_t DTYPE_F_t
 
+ctypedef fused FLOAT_t:
+    np.float32_t
+    np.float64_t
+
 
 @cython.boundscheck(False)
-def euclidean(np.ndarray[DTYPE_F_t, ndim=2] data,
-              np.ndarray[DTYPE_F_t, ndim=2] nodes):
+def euclidean(np.ndarray[FLOAT_t, ndim=2] data,
+              np.ndarray[FLOAT_t, ndim=2] nodes):
     """Fast euclidean distance
 
     Parameters
     ----------
-    data : np.ndarray - float64 - dim 2
+    data : np.ndarray - float32 or float64 - dim 2
         The first array, dim (M * N)
-    nodes : np.ndarray - float64 - dim 2
+    nodes : np.ndarray - same dtype as data - dim 2
         The second array, dim (P * N)
 
     Returns
     -------
-    euclidean distance : np.ndarray - float64 - dim2
+    euclidean distance : np.ndarray - same dtype as data - dim2
         The euclidean distance between each vector in a and each
         vector in b, dim (M * P)
 
@@ -35,7 +39,7 @@ def euclidean(np.ndarray[DTYPE_F_t, ndim=2] data,
     cdef int n_nodes = nodes.shape[0]
     cdef int length = data.shape[1]
 
-    cdef np.ndarray[DTYPE_F_t, ndim=3] diff = np.zeros([n_items, n_nodes, length], dtype=DTYPE_F)
+    cdef np.ndarray[FLOAT_t, ndim=3] diff = np.zeros([n_items, n_nodes, length], dtype=data.dtype)
 
     for i in range(n_items):
         for j in range(n_nodes):
@@ -0,0 +1,69 @@
+"""Distance functions based on the expanded euclidean norm."""
+import numpy as np
+
+
+def squared_norm(X, metric=None):
+    """
+    Calculate the squared L2 norm of each row of X.
+
+    Parameters
+    ----------
+    X : numpy array
+        A 2D array, dim (M * N)
+    metric : numpy array, optional, default None
+        A weight for each feature, dim (N,). If this is not None, the
+        weighted norm sum(metric * X ** 2) is calculated.
+
+    Returns
+    -------
+    norm : numpy array
+        The squared norm of each row, dim (M,)
+
+    """
+    if metric is None:
+        return np.einsum('ij,ij->i', X, X)
+    return np.einsum('ij,ij,j->i', X, X, metric)
+
+
+def euclidean_distance(data, nodes, nodes_norm=None, data_norm=None):
+    """
+    Euclidean distance without a difference tensor.
+
+    The distance is calculated through the expansion
+    ||x - w||^2 = ||x||^2 - 2 x.w + ||w||^2, which reduces the bulk of the
+    computation to a single matrix product. Only the (M * P) distance matrix
+    is allocated.
+
+    Parameters
+    ----------
+    data : numpy array
+        The first array, dim (M * N)
+    nodes : numpy array
+        The second array, dim (P * N)
+    nodes_norm : numpy array, optional, default None
+        The precomputed squared norm of each row in nodes, dim (P,). If this
+        is None, the norm is computed on the fly.
+    data_norm : numpy array, optional, default None
+        The precomputed squared norm of each row in data, dim (M,). If this
+        is None, the norm is computed on the fly.
+
+    Returns
+    -------
+    euclidean distance : numpy array
+        The euclidean distance between each vector in data and each
+        vector in nodes, dim (M * P)
+
+    """
+    if nodes_norm is None:
+        nodes_norm = squared_norm(nodes)
+    if data_norm is None:
+        data_norm = squared_norm(data)
+
+    distance = data.dot(nodes.T)
+    distance *= -2
+    distance += data_norm[:, None]
+    distance += nodes_norm[None, :]
+    # Rounding errors can make distances of (near-)identical vectors
+    # slightly negative.
+    np.maximum(distance, 0, out=distance)
+    return np.sqrt(distance, out=distance)
@@ -1,9 +1,22 @@
 """Neural gas."""
 import numpy as np
-import json
 from .base import Base
-from .components.utilities import Scaler
+from .components.utilities import (Scaler,
+                                   top_k,
+                                   put_along_rows,
+                                   array_cache)
+from .components.grid import SparseInfluence
 from .components.initializers import range_initialization
+from .components.serialization import load_model
+
+
+@array_cache()
+def rank_influence(num_ranked, influence_lambda, dtype):
+    """Calculate the influence of each rank in a neural gas."""
+    ranks = np.arange(num_ranked, dtype=dtype)
+    influence = np.exp(-ranks / dtype.type(influence_lambda))
+    influence.flags.writeable = False
+    return influence
 
 
 class Ng(Base):
@@ -33,9 +46,19 @@ class Ng(Base):
     nb_lambda : float
         Controls the steepness of the exponential function that decreases
         the neighborhood.
+    truncate : float, optional, default None
+        If this is not None, only the neurons with a rank below
+        truncate * lambda are updated, where lambda is the current value of
+        the influence. The influence of the other neurons is at most
+        exp(-truncate), so this changes the updates very little, but avoids
+        ranking and updating all neurons for each data point.
+    dtype : numpy dtype, optional, default np.float64
+        The floating point type of the weights and all computations.
 
     """
 
+    param_names = Base.param_names | {'truncate'}
+
     def __init__(self,
                  num_neurons,
                  learning_rate,
@@ -44,8 +67,11 @@ class Ng(Base):
                  initializer=range_initialization,
                  scaler=Scaler(),
                  lr_lambda=2.5,
-                 infl_lambda=2.5):
+                 infl_lambda=2.5,
+                 truncate=None,
+                 dtype=np.float64):
         """Organize your gas."""
+        self.truncate = truncate
         params = {'infl': {'value': influence,
                            'factor': infl_lambda,
                            'orig': np.sqrt(num_neurons)},
@@ -59,29 +85,57 @@ class Ng(Base):
                          'argmin',
                          'min',
                          initializer,
-                         scaler)
+                         scaler,
+                         dtype)
+
+    def _num_ranked(self):
+        """The number of neurons which are ranked for each data point."""
+        if self.truncate is None:
+            return self.num_neurons
+        k = int(np.ceil(self.truncate * self.params['infl']['value']))
+        return min(max(k, 1), self.num_neurons)
 
     def _get_bmu(self, activations):
-        """Get indices of bmus, sorted by their distance from input."""
+        """
+        Get indices of bmus, sorted by their distance from input.
+
+        If the gas is truncated, this returns the indices of the best
+        neurons, ordered by rank, instead of the rank of each neuron.
+        """
         # If the neural gas is a recursive neural gas, we need reverse argsort.
+        if self.truncate is not None:
+            return top_k(activations,
+                         self._num_ranked(),
+                         self.argfunc == 'argmax')[0]
         if self.argfunc == 'argmax':
             activations = -activations
         sort = np.argsort(activations, 1)
-        return sort.argsort()
+        # The ranks are the inverse permutation of the sort.
+        ranks = np.empty_like(sort)
+        put_along_rows(ranks, sort, np.arange(sort.shape[1]))
+        return ranks
 
     def _calculate_influence(self, influence_lambda):
         """Calculate the ranking influence."""
-        return np.exp(-np.arange(self.num_neurons) / influence_lambda)[:, None]
+        influence = rank_influence(self._num_ranked(),
+                                   float(influence_lambda),
+                                   self.dtype)
+        if self.truncate is not None:
+            return RankInfluence(influence)
+        return influence
 
     @classmethod
-    def load(cls, path):
+    def load(cls, path, mmap=False):
         """
-        Load a Neural Gas from a JSON file saved with this package.
+        Load a Neural Gas from a file saved with this package.
 
         Parameters
         ----------
         path : str
-            The path to the JSON file.
+            The path to the file.
+        mmap : bool, optional, default False
+            Whether to memory-map the weights from the file, instead of
+            reading them into memory.
 
         Returns
         -------
@@ -89,19 +143,66 @@ class Ng(Base):
             A neural gas.
 
         """
-        data = json.load(open(path))
+        data = load_model(path, mmap)
 
         weights = data['weights']
-        weights = np.asarray(weights, dtype=np.float64)
 
         s = cls(data['num_neurons'],
-                data['data_dimensionality'],
                 data['params']['lr']['orig'],
                 influence=data['params']['infl']['orig'],
+                data_dimensionality=data['data_dimensionality'],
                 lr_lambda=data['params']['lr']['factor'],
-                infl_lambda=data['params']['infl']['factor'])
+                infl_lambda=data['params']['infl']['factor'],
+                truncate=data.get('truncate'),
+                dtype=data.get('dtype', np.float64))
 
-        s.weights = weights
+        s.weights = np.asarray(weights, dtype=s.dtype)
         s.trained = True
 
         return s
+
+
+class RankInfluence(object):
+    """
+    The influence of the best ranked neurons in a truncated neural gas.
+
+    Indexing this object with the best neurons of each data point, ordered
+    by rank, returns the influence on these neurons as a SparseInfluence.
+
+    Parameters
+    ----------
+    values : numpy array
+        The influence of each rank, dim (num_ranked,).
+
+    """
+
+    def __init__(self, values):
+        """Store the influence of each rank."""
+        self.values = values
+
+    def __mul__(self, other):
+        """Scale the influence, e.g. by the learning rate."""
+        return RankInfluence(self.values * self.values.dtype.type(other))
+
+    __rmul__ = __mul__
+
+    def __getitem__(self, bmu):
+        """
+        Get the sparse influence of a batch of ranked neurons.
+
+        Parameters
+        ----------
+        bmu : numpy array
+            The best neurons for each item in the batch, ordered by rank,
+            dim (batch_size * num_ranked).
+
+        Returns
+        -------
+        influence : SparseInfluence
+            The batch item, the neuron and the influence of each
+            (batch item, neuron) pair.
+
+        """
+        rows = np.repeat(np.arange(len(bmu)), bmu.shape[1])
+        values = np.tile(self.values[:bmu.shape[1]], len(bmu))
+        return SparseInfluence(rows, bmu.ravel(), values)
@@ -4,6 +4,7 @@ import logging
 
 from .som import BaseSom
 from .components.initializers import range_initialization
+from .components.serialization import load_model
 from tqdm import tqdm
 
 
@@ -40,6 +41,8 @@ class PLSom(BaseSom):
     scaler : initialized Scaler instance, optional default None
         An initialized instance of Scaler() which is used to scale the data
         to have mean 0 and stdev 1.
+    dtype : numpy dtype, optional, default np.float64
+        The floating point type of the weights and all computations.
 
     Attributes
     ----------
@@ -48,9 +51,9 @@ class PLSom(BaseSom):
     num_neurons : int
         The dimensionality of the weight matrix, i.e. the number of
         neurons on the map.
-    distance_grid : numpy array
-        An array which contains the distance from each neuron to each
-        other neuron.
+    grid : Grid
+        The grid of the map, which is used to calculate the distance
+        between neurons on the map.
 
     """
 
@@ -58,14 +61,17 @@ class PLSom(BaseSom):
     param_names = {'map_dimensions',
                    'weights',
                    'data_dimensionality',
-                   'params'}
+                   'params',
+                   'beta',
+                   'dtype'}
 
     def __init__(self,
                  map_dimensions,
                  data_dimensionality=None,
                  beta=None,
                  initializer=range_initialization,
-                 scaler=None):
+                 scaler=None,
+                 dtype=np.float64):
         """Organize your maps parameterlessly."""
         super().__init__(map_dimensions,
                          data_dimensionality=data_dimensionality,
@@ -75,7 +81,8 @@ class PLSom(BaseSom):
                                        'factor': 1,
                                        'orig': 0}},
                          initializer=initializer,
-                         scaler=scaler)
+                         scaler=scaler,
+                         dtype=dtype)
         self.beta = beta if beta else 2
 
     def _epoch(self,
@@ -100,7 +107,8 @@ class PLSom(BaseSom):
         batch_size : int
             The batch size
         updates_epoch : int
-            The number of updates to perform per epoch
+            The number of updates to perform per epoch. Ignored, the
+            PLSom updates its parameters after every batch.
         constants : dict
             A dictionary containing the constants with which to update the
             parameters in self.parameters.
@@ -108,33 +116,55 @@ class PLSom(BaseSom):
             Whether to show a progressbar during training.
 
         """
-        # Create batches
+        self._partial_epoch(X, batch_size, show_progressbar)
+
+    def _partial_epoch(self, X, batch_size, show_progressbar):
+        """
+        Present a chunk of data once.
+
+        Because the PLSom adapts its neighborhood to the error, and the
+        largest error r is kept between calls, partial_fit lets the map
+        re-adapt when the distribution of the data changes.
+        """
         X_ = self._create_batches(X, batch_size)
-        X_len = np.prod(X.shape[:-1])
-
-        # Initialize the previous activation
-        prev = self._init_prev(X_)
-        prev = self.distance_function(X_[0], self.weights)[0]
-        influences = self._update_params(prev)
-
-        # Iterate over the training data
-        for idx, x in enumerate(tqdm(X_, disable=not show_progressbar)):
-
-            # Our batches are padded, so we need to
-            # make sure we know when we hit the padding
-            # so we don't inadvertently learn zeroes.
-            diff = X_len - (idx * batch_size)
-            if diff and diff < batch_size:
-                x = x[:diff]
-                # Prev_activation may be None
-                if prev is not None:
-                    prev = prev[:diff]
-
-            # if idx > 0 and idx % update_step == 0:
-            influences = self._update_params(prev)
-            prev = self._propagate(x,
-                                   influences,
-                                   prev_activation=prev)
+        for x in tqdm(X_, disable=not show_progressbar):
+            self._step(x)
+
+    def _step(self, x):
+        """
+        Present a single batch to the map, and update the weights.
+
+        The distances to the batch are calculated once, and are used both to
+        find the BMUs and to calculate epsilon, the error of the batch
+        relative to the largest error so far. Only the influence of each
+        BMU on the map is calculated, so the cost of a step is linear in
+        the number of neurons.
+
+        Parameters
+        ----------
+        x : numpy array
+            The batch, dim (batch_size * data_dimensionality).
+
+        Returns
+        -------
+        activation : numpy array
+            The distance from each item in the batch to each neuron.
+
+        """
+        activation = np.concatenate(self._sharded(self.forward, x))
+        influence = self._update_params(activation)
+        bmu = self._get_bmu(activation)
+
+        results = self._sharded(lambda rows: self._accumulate(
+                                    x[rows], influence[bmu[rows]]),
+                                np.arange(len(x)))
+        numerator, denominator = zip(*results)
+        self.weights += self._combine_update(numerator,
+                                             denominator,
+                                             self.weights,
+                                             x.shape[0])
+
+        return activation
 
     def _update_params(self, constants):
         """Update the params."""
@@ -144,14 +174,14 @@ class PLSom(BaseSom):
         epsilon = constants / self.params['r']['value']
         influence = self._calculate_influence(epsilon)
         # Account for learning rate
-        return influence * epsilon
+        return influence * float(epsilon)
 
     def _calculate_influence(self, neighborhood):
         """
         Pre-calculate the influence for a given value of sigma.
 
-        The neighborhood has size num_neurons * num_neurons, so for a
-        30 * 30 map, the neighborhood will be size (900, 900).
+        Epsilon, and therefore sigma, is continuous, and changes with every
+        batch, so the profiles are calculated without the cache.
 
         Parameters
         ----------
@@ -160,10 +190,44 @@ class PLSom(BaseSom):
 
         Returns
         -------
-        neighborhood : numpy array
+        neighborhood : SeparableInfluence
             The influence from each neuron to each other neuron.
 
         """
         n = (self.beta - 1) * np.log(1 + neighborhood*(np.e-1)) + 1
-        grid = np.exp((-self.distance_grid) / n**2)
-        return grid.reshape(self.num_neurons, self.num_neurons)[:, :, None]
+        return self.grid.influence(n, self.dtype, cached=False)
+
+    @classmethod
+    def load(cls, path, mmap=False):
+        """
+        Load a PLSom from a file saved with this package.
+
+        Parameters
+        ----------
+        path : str
+            The path to the file.
+        mmap : bool, optional, default False
+            Whether to memory-map the weights from the file, instead of
+            reading them into memory.
+
+        Returns
+        -------
+        s : cls
+            A PLSom.
+
+        """
+        data = load_model(path, mmap)
+
+        weights = data['weights']
+
+        s = cls(data['map_dimensions'],
+                data['data_dimensionality'],
+                beta=data.get('beta'),
+                dtype=data.get('dtype', np.float64))
+
+        # The params contain the largest error seen so far.
+        s.params = data['params']
+        s.weights = np.asarray(weights, dtype=s.dtype)
+        s.trained = True
+
+        return s
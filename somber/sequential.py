@@ -1,15 +1,20 @@
 """The sequential SOMs."""
 import logging
 
-import json
 import numpy as np
 
 from tqdm import tqdm
 from .som import Som
 from .ng import Ng
-from .components.utilities import shuffle
+from .components.utilities import (ChunkReader,
+                                   Lanes,
+                                   top_k,
+                                   take_along_rows,
+                                   put_along_rows)
+from .components.grid import SparseInfluence
 from .components.initializers import range_initialization
-from functools import reduce
+from .components.serialization import load_model
+from .distance import squared_norm
 
 logger = logging.getLogger(__name__)
 
@@ -17,29 +22,179 @@ logger = logging.getLogger(__name__)
 class SequentialMixin(object):
     """A base class for sequential SOMs, removing some code duplication."""
 
+    # Sequential SOMs depend on order, so can't be trained in batch.
+    algorithms = ("online",)
+
+    # The lengths of the sequences during fit, see fit.
+    _lengths = None
+
+    def fit(self, X, *args, **kwargs):
+        """
+        Fit the learner to one or more sequences.
+
+        Parameters
+        ----------
+        X : numpy array or list of numpy arrays
+            The input data. This is either a single sequence, which is split
+            into batch_size parts that are processed in parallel, or a list
+            of sequences of possibly different lengths. The sequences are
+            divided over batch_size lanes, which are processed in parallel,
+            and the context is reset at the start of each sequence.
+            Unlike other learners, sequential learners can not be fit on
+            streamed data, such as a memory-mapped array, because their
+            context depends on the order of the whole sequence. A list of
+            memory-mapped arrays is read into memory as a list of
+            sequences.
+
+        See Base.fit for the other parameters.
+
+        """
+        if isinstance(X, (np.memmap, ChunkReader)):
+            name = self.__class__.__name__
+            raise ValueError("{0} can not be fit on streamed data, such as "
+                             "a memory-mapped array. Please pass an array or "
+                             "a list of sequences.".format(name))
+        if isinstance(X, np.ndarray):
+            X = np.asarray(X)
+        else:
+            X = [np.asarray(x) for x in X]
+            self._lengths = [len(x) for x in X]
+            X = np.concatenate(X)
+
+        try:
+            return super().fit(X, *args, **kwargs)
+        finally:
+            self._lengths = None
+
+    def partial_fit(self, X, *args, **kwargs):
+        """Sequential models depend on order, so are fit on whole sequences."""
+        raise ValueError("{0} does not support partial_fit, please use "
+                         "fit.".format(self.__class__.__name__))
+
+    def _statistics_arrays(self, X, batch_size):
+        """The batch size sets the lanes, and therefore the BMUs."""
+        arrays = super()._statistics_arrays(X, batch_size)
+        return arrays + [np.asarray(batch_size)]
+
     def _init_prev(self, X):
         """Initialize the context vector for recurrent SOMs."""
-        return np.zeros((X.shape[1], self.num_neurons))
+        return np.zeros((X.num_lanes, self.num_neurons), dtype=self.dtype)
+
+    def _create_batches(self,
+                        X,
+                        batch_size,
+                        shuffle_data=False,
+                        lengths=None):
+        """
+        Divide the sequences in the data over batch_size lanes.
 
-    def _create_batches(self, X, batch_size, shuffle_data=False):
+        If lengths is None, the data is a single sequence, which is split
+        into batch_size parts of (almost) equal length.
+        """
+        if lengths is None:
+            num_parts = min(batch_size, len(X))
+            size, extra = divmod(len(X), num_parts)
+            lengths = [size + 1] * extra + [size] * (num_parts - extra)
+
+        return Lanes(lengths, batch_size)
+
+    def _epoch(self,
+               X,
+               epoch_idx,
+               batch_size,
+               updates_epoch,
+               constants,
+               show_progressbar):
         """
-        Create batches out of a sequence of data.
+        Run a single epoch.
+
+        At each time step, the current item of each lane is processed, and
+        lanes which have no more data are masked out.
+
+        Parameters
+        ----------
+        X : numpy array
+            The training data.
+        epoch_idx : int
+            The current epoch
+        batch_size : int
+            The number of lanes
+        updates_epoch : int
+            The number of updates to perform per epoch
+        constants : dict
+            A dictionary containing the constants with which to update the
+            parameters in self.parameters.
+        show_progressbar : bool
+            Whether to show a progressbar during training.
 
-        This function will append zeros to the end of your data to ensure that
-        all batches are even-sized. These are masked out during training.
         """
-        if shuffle_data:
-            X = shuffle(X)
+        lanes = self._create_batches(X, batch_size, lengths=self._lengths)
+        update_step = np.ceil(len(lanes) / updates_epoch)
+
+        prev = self._init_prev(lanes)
+        influences = self._update_params(constants)
+
+        lanes = tqdm(lanes, disable=not show_progressbar)
+        for idx, (rows, reset) in enumerate(lanes):
+            prev[reset] = 0
+
+            # If we hit an update step, perform an update.
+            if idx % update_step == 0:
+                influences = self._update_params(constants)
+                logger.info(self.params)
+
+            valid = rows >= 0
+            if valid.all():
+                prev = self._propagate(X[rows],
+                                       influences,
+                                       prev_activation=prev)
+            else:
+                prev[valid] = self._propagate(X[rows[valid]],
+                                              influences,
+                                              prev_activation=prev[valid])
+
+    def _forward_batches(self,
+                         X,
+                         batch_size,
+                         show_progressbar=False,
+                         n_jobs=1,
+                         function=None):
+        """
+        Calculate the activations of each time step of each lane.
 
-        if batch_size > X.shape[0]:
-            batch_size = X.shape[0]
+        Each time step depends on the previous one, so the time steps are
+        processed in order, and n_jobs is ignored.
+        """
+        lanes = self._create_batches(X, batch_size)
+        prev = self._init_prev(lanes)
+
+        for rows, reset in tqdm(lanes, disable=not show_progressbar):
+            prev[reset] = 0
+            valid = rows >= 0
+            rows = rows[valid]
+            x = X[rows].astype(self.dtype, copy=False)
+            prev[valid] = self.forward(x, prev_activation=prev[valid])
+            if function is None:
+                yield rows, prev[valid]
+            else:
+                yield rows, function(prev[valid])
+
+    def session(self, num_sessions=1):
+        """
+        Start an inference session, see Session.
 
-        max_x = int(np.ceil(X.shape[0] / batch_size))
-        # This line first resizes the data to
-        X = np.resize(X, (batch_size, max_x, X.shape[1]))
-        # Transposes it to (len(X) / batch_size, batch_size, data_dim)
+        Parameters
+        ----------
+        num_sessions : int, optional, default 1
+            The number of independent sequences to process at the same time.
 
-        return X.transpose((1, 0, 2))
+        Returns
+        -------
+        session : Session
+            A session whose contexts are all empty.
+
+        """
+        return Session(self, num_sessions)
 
     def forward(self, x, **kwargs):
         """Do a forward pass."""
@@ -47,23 +202,7 @@ class SequentialMixin(object):
 
     def predict_distance(self, X, batch_size=1, show_progressbar=False):
         """Predict distances to some input data."""
-        X = self._check_input(X)
-
-        X_shape = reduce(np.multiply, X.shape[:-1], 1)
-
-        batched = self._create_batches(X, batch_size, shuffle_data=False)
-
-        activations = []
-
-        activation = self._init_prev(batched)
-
-        for x in tqdm(batched, disable=not show_progressbar):
-            activation = self.forward(x, prev_activation=activation)[0]
-            activations.append(activation)
-
-        act = np.asarray(activations, dtype=np.float64).transpose((1, 0, 2))
-        act = act[:X_shape]
-        return act.reshape(X_shape, self.num_neurons)
+        return self.transform(X, batch_size, show_progressbar)
 
     def generate(self, num_to_generate, starting_place):
         """Generate data based on some initial position."""
@@ -72,7 +211,7 @@ class SequentialMixin(object):
         index = activ.__getattribute__(self.argfunc)(1)
         item = self.weights[index]
         for x in range(num_to_generate):
-            activ = self.forward(item, prev_activation=activ)[0]
+            activ = self.forward(item, prev_activation=activ)
             index = activ.__getattribute__(self.argfunc)(1)
             res.append(index)
             item = self.weights[index]
@@ -80,6 +219,124 @@ class SequentialMixin(object):
         return res
 
 
+class Session(object):
+    """
+    Incremental inference with a sequential model.
+
+    A session holds the context of one or more sequences, so that each new
+    item of a sequence can be processed without processing the items before
+    it again. Concurrent sequences are processed together, in a single
+    forward pass of the model.
+
+    Parameters
+    ----------
+    model : RecursiveSom or RecursiveNg
+        A trained sequential model.
+    num_sessions : int, optional, default 1
+        The number of independent sequences.
+
+    Attributes
+    ----------
+    context : numpy array
+        The activation of the model to the last item of each sequence,
+        dim (num_sessions * num_neurons).
+
+    """
+
+    def __init__(self, model, num_sessions=1):
+        """Start with an empty context for each sequence."""
+        self.model = model
+        self.context = np.zeros((num_sessions, model.num_neurons),
+                                dtype=model.dtype)
+
+    @property
+    def num_sessions(self):
+        """The number of sequences."""
+        return len(self.context)
+
+    def step(self, x):
+        """
+        Process the next item of each sequence.
+
+        Parameters
+        ----------
+        x : numpy array
+            The next item of each sequence, dim (num_sessions * dim). If
+            there is a single sequence, this can also be a vector.
+
+        Returns
+        -------
+        activation : numpy array
+            The activation of each neuron to the item, given the context,
+            dim (num_sessions * num_neurons).
+
+        """
+        x = np.asarray(x, dtype=self.model.dtype)
+        x = x.reshape(self.num_sessions, -1)
+        self.context = self.model.forward(x, prev_activation=self.context)
+        return self.context
+
+    def step_batch(self, xs):
+        """
+        Process several consecutive items of each sequence.
+
+        Parameters
+        ----------
+        xs : numpy array
+            The items, with time along the first axis,
+            dim (time * num_sessions * dim). If there is a single sequence,
+            this can also be (time * dim).
+
+        Returns
+        -------
+        activations : numpy array
+            The activation after each item,
+            dim (time * num_sessions * num_neurons).
+
+        """
+        return np.stack([self.step(x) for x in xs])
+
+    def predict(self, x):
+        """Process the next item of each sequence, and return the BMUs."""
+        activation = self.step(x)
+        return activation.__getattribute__(self.model.argfunc)(1)
+
+    def reset(self, sessions=None):
+        """
+        Empty the context of some or all sequences.
+
+        Parameters
+        ----------
+        sessions : int or numpy array, optional, default None
+            The sequences to reset. If this is None, all are reset.
+
+        """
+        if sessions is None:
+            sessions = slice(None)
+        self.context[sessions] = 0
+
+    def snapshot(self):
+        """Get a copy of the current context, which can be restored."""
+        return self.context.copy()
+
+    def restore(self, snapshot):
+        """
+        Restore the context from a snapshot.
+
+        Parameters
+        ----------
+        snapshot : numpy array
+            A snapshot taken with snapshot. It does not need to come from
+            the same session, but it should have the same number of neurons.
+
+        """
+        snapshot = np.asarray(snapshot, dtype=self.model.dtype)
+        if snapshot.ndim != 2 or snapshot.shape[1] != self.model.num_neurons:
+            raise ValueError("Your snapshot does not match the model: "
+                             "{0}".format(snapshot.shape))
+        self.context = snapshot.copy()
+
+
 class RecursiveMixin(SequentialMixin):
     """
     A recursive Mixin.
@@ -117,6 +374,17 @@ class RecursiveMixin(SequentialMixin):
     nb_lambda : float
         Controls the steepness of the exponential function that decreases
         the neighborhood.
+    truncate : float, optional, default None
+        If this is not None, the neighborhood is truncated, see Som and Ng.
+    context_k : int, optional, default None
+        If this is not None, only the context_k most active neurons of the
+        previous time step are used as context. Because the activations
+        decay exponentially with the distance, most of them are close to
+        zero, and the context distance can then be computed from
+        context_k columns of the context weights, instead of all of them.
+    dtype : numpy dtype, optional, default np.float64
+        The floating point type of the weights, the context weights and
+        all computations.
 
     Attributes
     ----------
@@ -125,9 +393,9 @@ class RecursiveMixin(SequentialMixin):
     num_neurons : int
         The dimensionality of the weight matrix, i.e. the number of
         neurons on the map.
-    distance_grid : numpy array
-        An array which contains the distance from each neuron to each
-        other neuron.
+    grid : Grid
+        The grid of the map, which is used to calculate the distance
+        between neurons on the map.
     context_weights : numpy array
         The weights which store the context dependence of the neurons.
 
@@ -141,26 +409,21 @@ class RecursiveMixin(SequentialMixin):
                    'weights',
                    'context_weights',
                    'alpha',
-                   'beta'}
+                   'beta',
+                   'truncate',
+                   'context_k',
+                   'dtype'}
 
     def _propagate(self, x, influences, **kwargs):
         prev = kwargs['prev_activation']
 
-        activation, diff_x, diff_y = self.forward(x, prev_activation=prev)
-        x_update, y_update = self.backward(diff_x,
+        activation = self.forward(x, prev_activation=prev)
+        x_update, y_update = self.backward(x,
                                            influences,
                                            activation,
-                                           diff_y=diff_y)
-        # If batch size is 1 we can leave out the call to mean.
-        if x_update.shape[0] == 1:
-            self.weights += x_update[0]
-        else:
-            self.weights += x_update.mean(0)
-
-        if y_update.shape[0] == 1:
-            self.context_weights += y_update[0]
-        else:
-            self.context_weights += y_update.mean(0)
+                                           prev_activation=prev)
+        self.weights += x_update
+        self.context_weights += y_update
 
         return activation
 
@@ -180,29 +443,86 @@ class RecursiveMixin(SequentialMixin):
 
         Returns
         -------
-        activations : tuple of activations and differences
-            A tuple containing the activation of each unit, the differences
-            between the weights and input and the differences between the
-            context input and context weights.
+        activations : numpy array
+            The activation of each unit to each input, given the
+            previous activation.
 
         """
         prev = kwargs['prev_activation']
 
-        # Differences is the components of the weights subtracted from
-        # the weight vector.
-        distance_x, diff_x = self.distance_function(x, self.weights)
-        distance_y, diff_y = self.distance_function(prev, self.context_weights)
+        distance_x = self._input_distance(x)
+        if self.context_k is None:
+            distance_y = self.distance_function(prev, self.context_weights)
+        else:
+            distance_y = self._sparse_context_distance(prev)
 
         x_ = distance_x * self.alpha
         y_ = distance_y * self.beta
         activation = np.exp(-(x_ + y_))
 
-        return activation, diff_x, diff_y
+        return activation
+
+    def _sparse_context(self, prev):
+        """Keep only the context_k largest activations of each row."""
+        k = min(self.context_k, self.num_neurons)
+        neurons = top_k(prev, k, largest=True)[0]
+        values = take_along_rows(prev, neurons)
+        return neurons, values
+
+    def _sparse_context_distance(self, prev):
+        """
+        Calculate the distance from a sparse context to the context weights.
+
+        The distance is calculated through the expansion
+        ||p - c||^2 = ||p||^2 - 2 p.c + ||c||^2, in which the product only
+        involves the context_k nonzero values of the sparse context p.
+        """
+        neurons, values = self._sparse_context(prev)
+        # The columns of the context weights of the active neurons,
+        # dim (batch_size * context_k * num_neurons).
+        columns = self.context_weights.T[neurons]
+        distance = np.einsum('bk,bkn->bn', values, columns)
+        distance *= -2
+        distance += squared_norm(values)[:, None]
+        distance += squared_norm(self.context_weights)[None, :]
+        np.maximum(distance, 0, out=distance)
+        return np.sqrt(distance, out=distance)
+
+    def _context_update(self, prev, influence):
+        """
+        Calculate the update to the context weights.
+
+        If the context is sparse, only the context_k columns of the active
+        neurons receive an update from the context, so the update is
+        accumulated from the (neuron, active neuron) pairs, instead of from
+        the full rows of the context.
+        """
+        if self.context_k is None:
+            return self._mean_update(prev, influence, self.context_weights)
+
+        neurons, values = self._sparse_context(prev)
+        if not isinstance(influence, SparseInfluence):
+            sparse = np.zeros_like(prev)
+            put_along_rows(sparse, neurons, values)
+            return self._mean_update(sparse, influence, self.context_weights)
+
+        rows, targets, weights = influence
+        n = self.num_neurons
+        cells = targets[:, None] * n + neurons[rows]
+        numerator = np.bincount(cells.ravel(),
+                                (weights[:, None] * values[rows]).ravel(),
+                                minlength=n * n).reshape(n, n)
+        denominator = np.bincount(targets, weights, minlength=n)
+
+        update = numerator.astype(self.dtype, copy=False)
+        update -= denominator[:, None] * self.context_weights
+        update /= prev.shape[0]
+        return update
 
     @classmethod
-    def load(cls, path):
+    def load(cls, path, mmap=False):
         """
-        Load a recursive SOM from a JSON file.
+        Load a recursive SOM from a file saved with this package.
 
         You can use this function to load weights of other SOMs.
         If there are no context weights, they will be set to 0.
@@ -210,7 +530,10 @@ class RecursiveMixin(SequentialMixin):
         Parameters
         ----------
         path : str
-            The path to the JSON file.
+            The path to the file.
+        mmap : bool, optional, default False
+            Whether to memory-map the weights and context weights from the
+            file, instead of reading them into memory.
 
         Returns
         -------
@@ -218,15 +541,12 @@ class RecursiveMixin(SequentialMixin):
             A som of the specified class.
 
         """
-        data = json.load(open(path))
+        data = load_model(path, mmap)
 
         weights = data['weights']
-        weights = np.asarray(weights, dtype=np.float64)
 
         try:
             context_weights = data['context_weights']
-            context_weights = np.asarray(context_weights,
-                                         dtype=np.float64)
         except KeyError:
             context_weights = np.zeros((len(weights), len(weights)))
 
@@ -237,17 +557,26 @@ class RecursiveMixin(SequentialMixin):
             alpha = 1.0
             beta = 1.0
 
-        s = cls(data['map_dimensions'],
-                data['data_dimensionality'],
-                data['params']['lr']['orig'],
-                influence=data['params']['infl']['orig'],
+        # Recursive SOMs have a map, recursive neural gases do not.
+        try:
+            shape = data['map_dimensions']
+        except KeyError:
+            shape = data['num_neurons']
+
+        s = cls(shape,
+                learning_rate=data['params']['lr']['orig'],
                 alpha=alpha,
                 beta=beta,
+                data_dimensionality=data['data_dimensionality'],
+                influence=data['params']['infl']['orig'],
                 lr_lambda=data['params']['lr']['factor'],
-                infl_lambda=data['params']['infl']['factor'])
+                infl_lambda=data['params']['infl']['factor'],
+                truncate=data.get('truncate'),
+                context_k=data.get('context_k'),
+                dtype=data.get('dtype', np.float64))
 
-        s.weights = weights
-        s.context_weights = context_weights
+        s.weights = np.asarray(weights, dtype=s.dtype)
+        s.context_weights = np.asarray(context_weights, dtype=s.dtype)
         s.trained = True
 
         return s
@@ -266,7 +595,10 @@ class RecursiveSom(RecursiveMixin, Som):
                  initializer=range_initialization,
                  scaler=None,
                  lr_lambda=2.5,
-                 infl_lambda=2.5):
+                 infl_lambda=2.5,
+                 truncate=None,
+                 context_k=None,
+                 dtype=np.float64):
         """Organize your maps recursively."""
         super().__init__(map_dimensions,
                          learning_rate,
@@ -275,32 +607,36 @@ class RecursiveSom(RecursiveMixin, Som):
                          initializer,
                          scaler,
                          lr_lambda,
-                         infl_lambda)
+                         infl_lambda,
+                         truncate,
+                         dtype)
 
         self.alpha = alpha
         self.beta = beta
+        self.context_k = context_k
         self.argfunc = 'argmax'
         self.valfunc = 'max'
 
         self.context_weights = np.zeros((self.num_neurons, self.num_neurons),
-                                        dtype=np.float64)
+                                        dtype=self.dtype)
 
-    def backward(self, diff_x, influences, activations, **kwargs):
+    def backward(self, x, influences, activations, **kwargs):
         """
         Backward pass through the network, including update.
 
         Parameters
         ----------
-        diff_x : numpy array
-            A matrix containing the differences between the input and neurons.
+        x : numpy array
+            The input data.
         influences : numpy array
             A matrix containing the influence each neuron has on each
             other neuron. This is used to calculate the updates.
         activations : numpy array
             The activations each neuron has to each data point. This is used
             to calculate the BMU.
-        differency_y : numpy array
-            The differences between the input and context neurons.
+        prev_activation : numpy array
+            The activation of the network in the previous time-step, which
+            is the input to the context weights.
 
         Returns
         -------
@@ -308,13 +644,13 @@ class RecursiveSom(RecursiveMixin, Som):
             The updates to the weights and context weights, respectively.
 
         """
-        diff_y = kwargs['diff_y']
+        prev = kwargs['prev_activation']
         bmu = self._get_bmu(activations)
         influence = influences[bmu]
 
         # Update
-        x_update = np.multiply(diff_x, influence)
-        y_update = np.multiply(diff_y, influence)
+        x_update = self._mean_update(x, influence, self.weights)
+        y_update = self._context_update(prev, influence)
 
         return x_update, y_update
 
@@ -322,6 +658,9 @@ class RecursiveSom(RecursiveMixin, Som):
 class RecursiveNg(RecursiveMixin, Ng):
     """Recursive version of the neural gas."""
 
+    param_names = (RecursiveMixin.param_names - {'map_dimensions'}
+                   | {'num_neurons'})
+
     def __init__(self,
                  num_neurons,
                  data_dimensionality,
@@ -332,41 +671,48 @@ class RecursiveNg(RecursiveMixin, Ng):
                  initializer=range_initialization,
                  scaler=None,
                  lr_lambda=2.5,
-                 infl_lambda=2.5):
+                 infl_lambda=2.5,
+                 truncate=None,
+                 context_k=None,
+                 dtype=np.float64):
         """Organize your gas recursively."""
         super().__init__(num_neurons,
-                         data_dimensionality,
                          learning_rate,
-                         influence,
-                         initializer,
-                         scaler,
-                         lr_lambda,
-                         infl_lambda)
+                         influence=influence,
+                         data_dimensionality=data_dimensionality,
+                         initializer=initializer,
+                         scaler=scaler,
+                         lr_lambda=lr_lambda,
+                         infl_lambda=infl_lambda,
+                         truncate=truncate,
+                         dtype=dtype)
 
         self.alpha = alpha
         self.beta = beta
+        self.context_k = context_k
         self.argfunc = 'argmax'
         self.valfunc = 'max'
 
         self.context_weights = np.zeros((self.num_neurons, self.num_neurons),
-                                        dtype=np.float64)
+                                        dtype=self.dtype)
 
-    def backward(self, diff_x, influences, activations, **kwargs):
+    def backward(self, x, influences, activations, **kwargs):
         """
         Backward pass through the network, including update.
 
         Parameters
         ----------
-        diff_x : numpy array
-            A matrix containing the differences between the input and neurons.
+        x : numpy array
+            The input data.
         influences : numpy array
             A matrix containing the influence each neuron has on each
             other neuron. This is used to calculate the updates.
         activations : numpy array
             The activations each neuron has to each data point. This is used
             to calculate the BMU.
-        differency_y : numpy array
-            The differences between the input and context neurons.
+        prev_activation : numpy array
+            The activation of the network in the previous time-step, which
+            is the input to the context weights.
 
         Returns
         -------
@@ -374,12 +720,12 @@ class RecursiveNg(RecursiveMixin, Ng):
             The updates to the weights and context weights, respectively.
 
         """
-        diff_y = kwargs['diff_y']
+        prev = kwargs['prev_activation']
         bmu = self._get_bmu(activations)
         influence = influences[bmu]
 
         # Update
-        x_update = np.multiply(diff_x, influence)
-        y_update = np.multiply(diff_y, influence)
+        x_update = self._mean_update(x, influence, self.weights)
+        y_update = self._context_update(prev, influence)
 
         return x_update, y_update
@@ -1,16 +1,26 @@
 """The standard SOM."""
 import logging
-import json
 import numpy as np
 
+from collections import namedtuple
 from .components.initializers import range_initialization
-from collections import Counter, defaultdict
+from .components.grid import Grid
+from .components.utilities import scatter_add, fingerprint, ChunkReader
+from .components.serialization import load_model
+from tqdm import tqdm
 from .base import Base
+from .distance import squared_norm
 
 
 logger = logging.getLogger(__name__)
 
 
+MapStatistics = namedtuple("MapStatistics", ["hits",
+                                             "quantization_error",
+                                             "umatrix",
+                                             "topographic_error"])
+
+
 class BaseSom(Base):
     """
     Base class of the classis SOM.
@@ -39,6 +49,14 @@ class BaseSom(Base):
     scaler : initialized Scaler instance
         An initialized instance of Scaler() which is used to scale the data
         to have mean 0 and stdev 1.
+    truncate : float, optional, default None
+        If this is not None, the neighborhood is cut off at truncate * sigma,
+        and only the neurons inside the neighborhood of a BMU are updated.
+        This makes the cost of an update independent of the size of the map.
+        Once the neighborhood covers more than 2% of the map, the full
+        neighborhood is used instead, which is faster.
+    dtype : numpy dtype, optional, default np.float64
+        The floating point type of the weights and all computations.
 
     """
 
@@ -49,14 +67,20 @@ class BaseSom(Base):
                  argfunc,
                  valfunc,
                  initializer,
-                 scaler):
+                 scaler,
+                 truncate=None,
+                 dtype=np.float64):
         """Initialize your maps."""
         # A tuple of dimensions
         # Usually (width, height), but can accomodate N-dimensional maps.
         self.map_dimensions = map_dimensions
         self.num_neurons = np.int(np.prod(self.map_dimensions))
-        # Initialize the distance grid: only needs to be done once.
-        self.distance_grid = self._initialize_distance_grid()
+        self.truncate = truncate
+        # Initialize the grid: only needs to be done once.
+        self.grid = Grid(self.map_dimensions)
+        # The last result of map_statistics, and the fingerprint of its
+        # input and weights.
+        self._statistics = None
 
         super().__init__(self.num_neurons,
                          data_dimensionality,
@@ -64,7 +88,8 @@ class BaseSom(Base):
                          'argmin',
                          'min',
                          initializer,
-                         scaler)
+                         scaler,
+                         dtype)
 
     def _init_prev(self, x):
         """Initialize recurrent SOMs."""
@@ -74,8 +99,12 @@ class BaseSom(Base):
         """
         Pre-calculate the influence for a given value of sigma.
 
-        The neighborhood has size num_neurons * num_neurons, so for a
-        30 * 30 map, the neighborhood will be size (900, 900).
+        The influence is not stored as a num_neurons * num_neurons matrix.
+        Instead, a SeparableInfluence is returned, which calculates the
+        influence of the BMUs on the map when it is indexed. If the SOM
+        was created with a value for truncate, a TruncatedInfluence is
+        returned instead, which only covers the neurons within
+        truncate * sigma of each neuron.
 
         Parameters
         ----------
@@ -84,51 +113,26 @@ class BaseSom(Base):
 
         Returns
         -------
-        neighborhood : numpy array
+        neighborhood : SeparableInfluence or TruncatedInfluence
             The influence from each neuron to each other neuron.
 
         """
-        grid = np.exp(-self.distance_grid / (neighborhood ** 2))
-        return grid.reshape(self.num_neurons, self.num_neurons)[:, :, None]
+        if self.truncate is not None:
+            return self.grid.truncated_influence(neighborhood,
+                                                 self.truncate,
+                                                 self.dtype)
 
-    def _initialize_distance_grid(self):
-        """Initialize the distance grid by calls to _grid_dist."""
-        p = [self._grid_distance(i) for i in range(self.num_neurons)]
-        return np.array(p)
+        return self.grid.influence(neighborhood, self.dtype)
 
-    def _grid_distance(self, index):
+    @property
+    def distance_grid(self):
         """
-        Calculate the distance grid for a single index position.
+        The squared grid distance from each neuron to each other neuron.
 
-        This is pre-calculated for fast neighborhood calculations
-        later on (see _calc_influence).
+        This is calculated from the grid on each access, and allocates
+        num_neurons ** 2 values.
         """
-        # Take every dimension but the first in reverse
-        # then reverse that list again.
-        dimensions = np.cumprod(self.map_dimensions[1::][::-1])[::-1]
-
-        coord = []
-        for idx, dim in enumerate(dimensions):
-            if idx != 0:
-                value = (index % dimensions[idx-1]) // dim
-            else:
-                value = index // dim
-            coord.append(value)
-
-        coord.append(index % self.map_dimensions[-1])
-
-        for idx, (width, row) in enumerate(zip(self.map_dimensions, coord)):
-            x = np.abs(np.arange(width) - row) ** 2
-            dims = self.map_dimensions[::-1]
-            if idx:
-                dims = dims[:-idx]
-            x = np.broadcast_to(x, dims).T
-            if idx == 0:
-                distance = np.copy(x)
-            else:
-                distance += x.T
-
-        return distance
+        return self.grid.distance_grid()
 
     def topographic_error(self, X, batch_size=1):
         """
@@ -156,137 +160,163 @@ class BaseSom(Base):
             for each data point.
 
         """
-        dist = self.transform(X, batch_size)
-        # Sort the distances and get the indices of the two smallest distances
-        # for each datapoint.
-        res = dist.argsort(1)[:, :2]
-        # Lookup the euclidean distance between these points in the distance
-        # grid
-        dgrid = self.distance_grid.reshape(self.num_neurons, self.num_neurons)
-        res = np.asarray([dgrid[x, y] for x, y in res])
+        # Get the indices of the two best matching units for each datapoint.
+        res, _ = self.top_k_bmus(X, 2, batch_size)
+        return self._topographic_error(res)
+
+    def _topographic_error(self, bmus):
+        """Calculate the topographic error from the two best BMUs."""
+        # On a map with one neuron, there is no second BMU.
+        if bmus.shape[1] < 2:
+            return 0.0
+        # Lookup the distance between these points on the grid.
+        res = self.grid.distance(bmus[:, 0], bmus[:, 1])
         # Subtract 1.0 because 1.0 is the smallest distance.
         return np.sum(res > 1.0) / len(res)
 
-    def neighbors(self, distance=2.0):
-        """Get all neighbors for all neurons."""
-        dgrid = self.distance_grid.reshape(self.num_neurons, self.num_neurons)
-        for x, y in zip(*np.nonzero(dgrid <= distance)):
-            if x != y:
-                yield x, y
+    def map_statistics(self, X, batch_size=100):
+        """
+        Calculate the statistics used to monitor a map in a single pass.
 
-    def neighbor_difference(self):
-        """Get the euclidean distance between a node and its neighbors."""
-        differences = np.zeros(self.num_neurons)
-        num_neighbors = np.zeros(self.num_neurons)
+        The two best matching units of each data point are calculated once,
+        and all statistics are derived from them. The result is cached, and
+        is only calculated again if the data or the weights change. Checking
+        whether they changed hashes all of X, so even a cached call costs a
+        full pass over the data.
 
-        distance, _ = self.distance_function(self.weights, self.weights)
-        for x, y in self.neighbors():
-            differences[x] += distance[x, y]
-            num_neighbors[x] += 1
+        Parameters
+        ----------
+        X : numpy array
+            The input data.
+        batch_size : int, optional, default 100
+            The batch size to use when calculating the BMUs.
 
-        return differences / num_neighbors
+        Returns
+        -------
+        statistics : MapStatistics
+            A named tuple with the number of hits of each neuron, the mean
+            activation of each neuron to the data points for which it is the
+            BMU (i.e. the quantization error for a regular SOM), the
+            U-matrix, which is the mean distance from each neuron to its
+            neighbors, and the topographic error. All but the topographic
+            error have the shape of the map.
 
-    def spread(self, X):
         """
-        Calculate the average spread for each node.
+        X = self._check_input(X)
+        key = fingerprint(*self._statistics_arrays(X, batch_size))
 
-        The average spread is a measure of how far each neuron is from the
-        data points which cluster to it.
+        if self._statistics is not None and self._statistics[0] == key:
+            return self._statistics[1]
+
+        bmus, activations = self.top_k_bmus(X, 2, batch_size)
+
+        hits = np.bincount(bmus[:, 0], minlength=self.num_neurons)
+        total = np.bincount(bmus[:, 0],
+                            activations[:, 0],
+                            minlength=self.num_neurons)
+        error = np.zeros(self.num_neurons)
+        np.divide(total, hits, out=error, where=hits > 0)
+
+        statistics = MapStatistics(
+            hits.reshape(self.map_dimensions),
+            error.reshape(self.map_dimensions),
+            self.neighbor_difference().reshape(self.map_dimensions),
+            self._topographic_error(bmus))
+
+        self._statistics = (key, statistics)
+        return statistics
+
+    def _statistics_arrays(self, X, batch_size):
+        """
+        Get the arrays the result of map_statistics depends on.
+
+        The batch size does not change the BMUs of a regular SOM, so it is
+        left out, and the cached result is reused for any batch size.
+        """
+        arrays = [X, self.weights]
+        if self.inference is not None and self.inference.metric is not None:
+            arrays.append(self.inference.metric)
+        if self.index is not None:
+            arrays += [self.index.centroids, np.asarray(self.index.n_probe)]
+        return arrays
+
+    def neighbors(self, distance=2.0):
+        """Get all neighbors for all neurons."""
+        for x, y in zip(*self.grid.neighbors(distance)):
+            yield x, y
+
+    def neighbor_difference(self, block_size=2**16):
+        """
+        Get the euclidean distance between a node and its neighbors.
+
+        If an inference form was prepared with prepare_inference, the
+        distance is measured in the space of the scaler, like the distances
+        of the other inference methods.
 
         Parameters
         ----------
-        X : numpy array
-            The input data.
+        block_size : int, optional, default 65536
+            The number of pairs of neighbors to calculate the distance for
+            at the same time.
 
         Returns
         -------
-        spread : numpy array
-            The average distance from each neuron to each data point.
+        difference : numpy array
+            The mean distance from each neuron to its neighbors.
 
         """
-        distance, _ = self.distance_function(X, self.weights)
-        dists_per_neuron = defaultdict(list)
-        for x, y in zip(np.argmin(distance, 1), distance):
-            dists_per_neuron[x].append(y[x])
-
-        out = np.zeros(self.num_neurons)
-        average_spread = {k: np.mean(v)
-                          for k, v in dists_per_neuron.items()}
+        x, y = self.grid.neighbors(2.0)
+        metric = self._metric()
 
-        for x, y in average_spread.items():
-            out[x] = y
-        return out
+        differences = np.zeros(self.num_neurons)
+        for start in range(0, len(x), block_size):
+            block = slice(start, start + block_size)
+            diff = self.weights[x[block]] - self.weights[y[block]]
+            distance = np.sqrt(squared_norm(diff, metric))
+            differences += np.bincount(x[block],
+                                       distance,
+                                       minlength=self.num_neurons)
+
+        num_neighbors = np.bincount(x, minlength=self.num_neurons)
+        return differences / num_neighbors
 
-    def receptive_field(self,
-                        X,
-                        identities,
-                        max_len=10,
-                        threshold=0.9,
-                        batch_size=1):
+    def spread(self, X, batch_size=100):
         """
-        Calculate the receptive field of the SOM on some data.
+        Calculate the average spread for each node.
 
-        The receptive field is the common ending of all sequences which
-        lead to the activation of a given BMU. If a SOM is well-tuned to
-        specific sequences, it will have longer receptive fields, and therefore
-        gives a better description of the dynamics of a given system.
+        The average spread is a measure of how far each neuron is from the
+        data points which cluster to it. If an inference form was prepared
+        with prepare_inference, the distance is measured in the space of the
+        scaler.
 
         Parameters
         ----------
         X : numpy array
-            Input data.
-        identities : list
-            A list of symbolic identities associated with each input.
-            We expect this list to be as long as the input data.
-        max_len : int, optional, default 10
-            The maximum length to attempt to find. Raising this increases
-            memory use.
-        threshold : float, optional, default .9
-            The threshold at which we consider a receptive field
-            valid. If at least this proportion of the sequences of a neuron
-            have the same suffix, that suffix is counted as acquired by the
-            SOM.
-        batch_size : int, optional, default 1
-            The batch size to use in prediction
+            The input data.
+        batch_size : int, optional, default 100
+            The number of data points to calculate the distances for at the
+            same time.
 
         Returns
         -------
-        receptive_fields : dict
-            A dictionary mapping from the neuron id to the found sequences
-            for that neuron. The sequences are represented as lists of
-            symbols from identities.
+        spread : numpy array
+            The average distance from each neuron to each data point.
 
         """
-        receptive_fields = defaultdict(list)
-        predictions = self.predict(X, batch_size)
+        total = np.zeros(self.num_neurons)
+        counts = np.zeros(self.num_neurons, dtype=np.int64)
+        for start in range(0, len(X), batch_size):
+            distance = self._input_distance(X[start:start+batch_size])
+            bmus = distance.argmin(1)
+            distance = distance[np.arange(len(bmus)), bmus]
+            total += np.bincount(bmus, distance, minlength=self.num_neurons)
+            counts += np.bincount(bmus, minlength=self.num_neurons)
 
-        if len(predictions) != len(identities):
-            raise ValueError("X and identities are not the same length: "
-                             "{0} and {1}".format(len(X), len(identities)))
+        out = np.zeros(self.num_neurons)
+        np.divide(total, counts, out=out, where=counts > 0)
+        return out
 
-        for idx, p in enumerate(predictions.tolist()):
-            receptive_fields[p].append(identities[idx+1 - max_len:idx+1])
-
-        rec = {}
-
-        for k, v in receptive_fields.items():
-            # if there's only one sequence, we don't know
-            # anything abouw how salient it is.
-            seq = []
-            if len(v) <= 1:
-                continue
-            else:
-                for x in reversed(list(zip(*v))):
-                    x = Counter(x)
-                    if x.most_common(1)[0][1] / sum(x.values()) > threshold:
-                        seq.append(x.most_common(1)[0][0])
-                    else:
-                        rec[k] = seq
-                        break
-
-        return rec
-
-    def invert_projection(self, X, identities):
+    def invert_projection(self, X, identities, batch_size=100):
         """
         Calculate the inverted projection.
 
@@ -303,6 +333,8 @@ class BaseSom(Base):
         identities : list
             A list of names for each of the input data. Must be the same
             length as X.
+        batch_size : int, optional, default 100
+            The batch size to use in transformation.
 
         Returns
         -------
@@ -310,18 +342,30 @@ class BaseSom(Base):
             An array with the same shape as the map
 
         """
-        distances = self.transform(X)
+        X = self._check_input(X)
 
-        if len(distances) != len(identities):
+        if len(X) != len(identities):
             raise ValueError("X and identities are not the same length: "
                              "{0} and {1}".format(len(X), len(identities)))
 
-        node_match = []
-
-        for d in distances.__getattribute__(self.argfunc)(0):
-            node_match.append(identities[d])
-
-        return np.array(node_match)
+        # Keep the best matching input of each neuron over all batches.
+        sign = -1 if self.argfunc == 'argmax' else 1
+        best = np.full(self.num_neurons, np.inf)
+        match = np.zeros(self.num_neurons, dtype=np.int64)
+        indices = np.arange(len(X))
+
+        for rows, activation in self._forward_batches(X, batch_size):
+            activation = activation * sign
+            winner = activation.argmin(0)
+            value = activation[winner, np.arange(self.num_neurons)]
+            rows = indices[rows]
+            # Ties are resolved in favor of the earliest input.
+            better = (value < best) | ((value == best) &
+                                       (rows[winner] < match))
+            best[better] = value[better]
+            match[better] = rows[winner][better]
+
+        return np.array([identities[x] for x in match])
 
     def map_weights(self):
         """
@@ -391,6 +435,13 @@ class Som(BaseSom):
     infl_lambda : float
         Controls the steepness of the exponential function that decreases
         the neighborhood.
+    truncate : float, optional, default None
+        If this is not None, the neighborhood is cut off at truncate * sigma.
+        A value of 3 or 4 gives results which are close to those of the full
+        neighborhood, while making updates on large maps a lot cheaper.
+    dtype : numpy dtype, optional, default np.float64
+        The floating point type of the weights and all computations.
+        np.float32 halves the memory use, and is faster.
 
     Attributes
     ----------
@@ -399,17 +450,21 @@ class Som(BaseSom):
     num_neurons : int
         The dimensionality of the weight matrix, i.e. the number of
         neurons on the map.
-    distance_grid : numpy array
-        An array which contains the distance from each neuron to each
-        other neuron.
+    grid : Grid
+        The grid of the map, which is used to calculate the distance
+        between neurons on the map.
 
     """
 
+    algorithms = ("online", "batch")
+
     # Static property names
     param_names = {'map_dimensions',
                    'weights',
                    'data_dimensionality',
-                   'params'}
+                   'params',
+                   'truncate',
+                   'dtype'}
 
     def __init__(self,
                  map_dimensions,
@@ -419,7 +474,9 @@ class Som(BaseSom):
                  initializer=range_initialization,
                  scaler=None,
                  lr_lambda=2.5,
-                 infl_lambda=2.5):
+                 infl_lambda=2.5,
+                 truncate=None,
+                 dtype=np.float64):
         """Organize your maps."""
         if influence is None:
             # Add small constant to sigma to prevent
@@ -441,17 +498,120 @@ class Som(BaseSom):
                          'argmin',
                          'min',
                          initializer,
-                         scaler)
+                         scaler,
+                         truncate,
+                         dtype)
+
+    def _batch_epoch(self,
+                     X,
+                     epoch_idx,
+                     batch_size,
+                     updates_epoch,
+                     constants,
+                     show_progressbar):
+        """
+        Run a single epoch of the batch SOM algorithm.
+
+        In the batch algorithm, each weight is set to the mean of all data
+        points, weighted by the influence their BMU has on the neuron.
+        Because this only depends on the number of data points and the sum
+        of the data points per BMU, the order of the data does not matter,
+        and the data does not need to be shuffled.
+
+        Parameters
+        ----------
+        X : numpy array
+            The training data.
+        epoch_idx : int
+            The current epoch
+        batch_size : int
+            The number of data points for which to calculate the BMU at
+            the same time.
+        updates_epoch : int
+            The number of updates to perform per epoch. Ignored, the
+            batch algorithm performs one update per epoch.
+        constants : dict
+            A dictionary containing the constants with which to update the
+            parameters in self.parameters.
+        show_progressbar : bool
+            Whether to show a progressbar during training.
+
+        """
+        influence = self._update_params(constants)
+        logger.info(self.params)
+
+        counts, sums = self._bmu_statistics(X, batch_size, show_progressbar)
+
+        numerator = influence.smooth(sums)
+        denominator = influence.smooth(counts[:, None].astype(sums.dtype))
+        # Neurons which are not influenced by any data point keep
+        # their weight.
+        mask = denominator[:, 0] > 0
+        self.weights[mask] = numerator[mask] / denominator[mask]
+
+    def _bmu_statistics(self, X, batch_size, show_progressbar=False):
+        """
+        Calculate the number of data points and their sum per BMU.
+
+        Parameters
+        ----------
+        X : numpy array
+            The input data.
+        batch_size : int
+            The number of data points to process at the same time.
+        show_progressbar : bool, optional, default False
+            Whether to show a progressbar.
+
+        Returns
+        -------
+        statistics : tuple of numpy arrays
+            The number of data points for which each neuron is the BMU, and
+            the sum of these data points, respectively.
+
+        """
+        def statistics(X):
+            counts = np.zeros(self.num_neurons, dtype=np.int64)
+            # Sums are accumulated in double precision, regardless of
+            # the dtype of the weights.
+            sums = np.zeros(self.weights.shape, dtype=np.float64)
+
+            batches = range(0, len(X), batch_size)
+            for idx in tqdm(batches, disable=not show_progressbar):
+                x = X[idx:idx+batch_size]
+                bmu = self._get_bmu(self.forward(x))
+                counts += np.bincount(bmu, minlength=self.num_neurons)
+                scatter_add(sums, bmu, x)
+
+            return counts, sums
+
+        counts = np.zeros(self.num_neurons, dtype=np.int64)
+        sums = np.zeros(self.weights.shape, dtype=np.float64)
+        # Streamed data is processed one chunk at a time.
+        if isinstance(X, ChunkReader):
+            chunks = X.chunks()
+        else:
+            chunks = [X]
+
+        for chunk in chunks:
+            # Each shard is processed by a single thread.
+            for c, s in self._sharded(statistics, chunk):
+                counts += c
+                sums += s
+
+        return counts, sums
 
     @classmethod
-    def load(cls, path):
+    def load(cls, path, mmap=False):
         """
-        Load a SOM from a JSON file saved with this package..
+        Load a SOM from a file saved with this package.
 
         Parameters
         ----------
         path : str
-            The path to the JSON file.
+            The path to the file.
+        mmap : bool, optional, default False
+            Whether to memory-map the weights from the file, instead of
+            reading them into memory.
 
         Returns
         -------
@@ -459,19 +619,20 @@ class Som(BaseSom):
             A som of the specified class.
 
         """
-        data = json.load(open(path))
+        data = load_model(path, mmap)
 
         weights = data['weights']
-        weights = np.asarray(weights, dtype=np.float64)
 
         s = cls(data['map_dimensions'],
                 data['params']['lr']['orig'],
                 data['data_dimensionality'],
                 influence=data['params']['infl']['orig'],
                 lr_lambda=data['params']['lr']['factor'],
-                infl_lambda=data['params']['infl']['factor'])
+                infl_lambda=data['params']['infl']['factor'],
+                truncate=data.get('truncate'),
+                dtype=data.get('dtype', np.float64))
 
-        s.weights = weights
+        s.weights = np.asarray(weights, dtype=s.dtype)
         s.trained = True
 
         return s
@@ -0,0 +1,228 @@
+"""Parallel hyper-parameter sweeps."""
+import functools
+import itertools
+import logging
+
+import numpy as np
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from .components.utilities import Scaler
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8, the data is copied to each worker instead, see sweep.
+    shared_memory = None
+
+
+logger = logging.getLogger(__name__)
+
+
+SweepResult = namedtuple("SweepResult", ["table", "best"])
+
+# The shared input data of a worker process, see _attach.
+_shared = None
+
+
+def _receive(X):
+    """Give a worker process a copy of the input data."""
+    global _shared
+    _shared = (None, X)
+
+
+def _attach(name, shape, dtype):
+    """Attach a worker process to the shared input data."""
+    global _shared
+    memory = shared_memory.SharedMemory(name=name)
+    X = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+    X.flags.writeable = False
+    # Keep a reference to the memory, so the buffer stays valid.
+    _shared = (memory, X)
+
+
+def _fit(model, config, fit_params, seed, X):
+    """Train a single configuration."""
+    np.random.seed(seed)
+    learner = model(scaler=None, **config)
+    learner.fit(X, **fit_params)
+    return learner
+
+
+def _input_error(learner, X, batch_size=100):
+    """
+    Calculate the distance between each data point and the weights of its BMU.
+
+    The quantization error of learners whose BMU is the neuron with the
+    largest activation, such as recursive learners, is that activation,
+    which depends on parameters such as alpha and beta. This distance only
+    depends on the input weights, so it can be compared across
+    configurations.
+    """
+    bmus = learner.predict(X, batch_size=batch_size)
+    error = np.empty(len(X))
+    for start in range(0, len(X), batch_size):
+        rows = slice(start, start + batch_size)
+        diff = X[rows] - learner.weights[bmus[rows]]
+        error[rows] = np.sqrt(np.einsum('ij,ij->i', diff, diff))
+    return error
+
+
+def _train(model, config, fit_params, scores, seed, X=None):
+    """
+    Train and score a single configuration.
+
+    Only the scores are returned, so that the trained learners, which can
+    be large, are not sent back from the worker processes.
+    """
+    if X is None:
+        X = _shared[1]
+    learner = _fit(model, config, fit_params, seed, X)
+
+    result = {}
+    for score in scores:
+        if score == "quantization_error" and learner.valfunc == "max":
+            score_function = functools.partial(_input_error, learner)
+        else:
+            score_function = getattr(learner, score)
+        result[score] = float(np.mean(score_function(X, batch_size=100)))
+    return result
+
+
+def sweep(model,
+          X,
+          param_grid,
+          fit_params=None,
+          scores=("quantization_error", "topographic_error"),
+          scale=True,
+          n_jobs=None,
+          seed=None):
+    """
+    Train and score a grid of configurations of a model in parallel.
+
+    The data is scaled once, and put in shared memory, from which all worker
+    processes read it without copying it. Each configuration is trained by a
+    worker, and scored on the data. The workers only send back the scores,
+    and the best configuration is trained again in this process, with the
+    same seed, to return the best model.
+
+    Parameters
+    ----------
+    model : class
+        The class of the model, e.g. Som or RecursiveSom.
+    X : numpy array
+        The training data, which is also used for scoring.
+    param_grid : dict
+        A dictionary mapping from the names of the parameters of the model
+        to a list of values to try. Every combination of values is trained.
+        Parameters which should not vary, such as map_dimensions, can be
+        given as a list of one value.
+    fit_params : dict, optional, default None
+        Keyword arguments for fit, e.g. num_epochs and batch_size.
+    scores : tuple of str, optional
+        The names of the methods used to score each model, which should take
+        the data and a batch size. Scores which the model does not have are
+        skipped. The models are ranked by the first score, lower is better.
+        For models whose BMU is the neuron with the largest activation, such
+        as RecursiveSom, the quantization error is the distance between each
+        data point and the weights of its BMU, instead of the activation of
+        the BMU, which can not be compared across values of alpha and beta.
+    scale : bool, optional, default True
+        Whether to scale the data with a Scaler before training. The scores
+        are calculated on the scaled data, but the weights of the returned
+        models are transformed back, and the models are given the scaler,
+        exactly as if they were fit with a scaler.
+    n_jobs : int, optional, default None
+        The number of processes. If this is None, the number of CPUs is
+        used. If this is 1, the models are trained in this process. On
+        Python 3.8 and later, the workers share the data, on earlier
+        versions each worker gets a copy.
+    seed : int, optional, default None
+        If this is not None, configuration i is trained with random seed
+        seed + i, which makes the sweep reproducible. Otherwise, the seeds
+        are drawn from the global numpy random state.
+
+    Returns
+    -------
+    result : SweepResult
+        A named tuple with the table, a list with a dictionary for each
+        configuration containing its parameters and scores, sorted from
+        best to worst, and the best model.
+
+    """
+    fit_params = dict(fit_params or {})
+    scores = [s for s in scores if hasattr(model, s)]
+    if not scores:
+        raise ValueError("{0} has none of the scores.".format(model.__name__))
+
+    names = sorted(param_grid)
+    configs = [dict(zip(names, values))
+               for values in itertools.product(*(param_grid[k]
+                                                 for k in names))]
+    # The best configuration is trained again with its seed, see below, so
+    # every configuration needs one.
+    if seed is None:
+        seeds = np.random.randint(2 ** 31, size=len(configs)).tolist()
+    else:
+        seeds = [seed + idx for idx in range(len(configs))]
+
+    X = np.ascontiguousarray(X)
+    scaler = None
+    if scale:
+        scaler = Scaler()
+        X = scaler.fit_transform(X)
+
+    if n_jobs == 1:
+        results = [_train(model, c, fit_params, scores, s, X)
+                   for c, s in zip(configs, seeds)]
+    elif shared_memory is None:
+        with ProcessPoolExecutor(n_jobs,
+                                 initializer=_receive,
+                                 initargs=(X,)) as pool:
+            futures = [pool.submit(_train, model, c, fit_params, scores, s)
+                       for c, s in zip(configs, seeds)]
+            results = [f.result() for f in futures]
+    else:
+        # Shared memory can not be empty.
+        size = max(X.nbytes, 1)
+        memory = shared_memory.SharedMemory(create=True, size=size)
+        try:
+            shared = np.ndarray(X.shape, dtype=X.dtype, buffer=memory.buf)
+            shared[:] = X
+            # The memory can only be closed once no arrays refer to it.
+            del shared
+            with ProcessPoolExecutor(n_jobs,
+                                     initializer=_attach,
+                                     initargs=(memory.name,
+                                               X.shape,
+                                               X.dtype)) as pool:
+                futures = [pool.submit(_train,
+                                       model,
+                                       c,
+                                       fit_params,
+                                       scores,
+                                       s)
+                           for c, s in zip(configs, seeds)]
+                results = [f.result() for f in futures]
+        finally:
+            memory.close()
+            memory.unlink()
+
+    ranking = np.array([r[scores[0]] for r in results])
+    order = np.argsort(ranking, kind='mergesort')
+    table = []
+    for idx in order:
+        row = dict(configs[idx])
+        row.update(results[idx])
+        table.append(row)
+        logger.info(row)
+
+    # Only the scores are sent back by the workers, so the best model is
+    # trained again, which gives the same model because the seed is the
+    # same.
+    best = _fit(model, configs[order[0]], fit_params, seeds[order[0]], X)
+    if scaler is not None:
+        best.scaler = scaler
+        scaler.inverse_transform(best.weights, out=best.weights)
+
+    return SweepResult(table, best)